@@ -0,0 +1,263 @@
+# -*- coding:utf-8 -*-
+"""
+asyncio engine for tasks of many small files, requests of all files share
+one event loop and a keep-alive connection pool limited per host
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from hwget.base import Downloader, SourceChanged
+
+LOG = logging.getLogger(__name__)
+
+
+class AsyncDownloader(Downloader):
+    """
+    Downloader whose probes and downloads of small files run on an event
+    loop in a background thread, files larger than small_size are
+    downloaded in ranges by Downloader. the interface is the same, so
+    callers in several threads share the loop and its connections.
+    submit starts a small file without a thread waiting on it
+    """
+
+    def __init__(self, threads=1, min_segment_size=16*1024*1024, timeout=60, meta=None, small_size=8*1024*1024,
+                 connections=256, per_host=32, files=128):
+        """
+
+        :param threads: 大文件的并发连接数
+        :param min_segment_size: 分段下载时每段最小字节数
+        :param timeout: 连接/读取超时 秒
+        :param meta: dict {url: meta} probed already
+        :param small_size: 不超过该字节数的文件在事件循环中整体下载
+        :param connections: 事件循环的连接数上限
+        :param per_host: 每个主机的连接数上限
+        :param files: 事件循环中同时下载的小文件数
+        """
+        if aiohttp is None:
+            e = "aiohttp is required for AsyncDownloader, pip install aiohttp"
+            LOG.error(e)
+            raise Exception(e)
+
+        super(AsyncDownloader, self).__init__(threads, min_segment_size, timeout, meta)
+        self.small_size = small_size
+        self.connections = connections
+        self.per_host = per_host
+        self.files = max(files, 1)
+        self.slots = None
+        self.loop = None
+        self.client = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+
+        with self.lock:
+            if self.loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="hwget-aio", daemon=True).start()
+            self.client = asyncio.run_coroutine_threadsafe(self._session(), loop).result()
+            self.loop = loop
+
+    async def _session(self):
+
+        # created on the loop, a semaphore is bound to the loop it is used on
+        self.slots = asyncio.Semaphore(self.files)
+        connector = aiohttp.TCPConnector(limit=self.connections, limit_per_host=self.per_host)
+        return aiohttp.ClientSession(connector=connector, headers=self.HEADER,
+                                     timeout=aiohttp.ClientTimeout(sock_connect=self.timeout, sock_read=self.timeout))
+
+    def _run(self, coro):
+        """
+        run coro on the event loop and wait for its result
+        """
+        self._start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def close(self):
+        """
+        close the connections and stop the event loop
+        """
+        with self.lock:
+            if self.loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(self.client.close(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop = None
+            self.client = None
+
+    @staticmethod
+    def _parse_meta(response, size):
+
+        return {
+            "size": size,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "accept_ranges": response.status == 206 or
+                             response.headers.get("Accept-Ranges", "").lower() == "bytes"
+        }
+
+    async def _aprobe(self, url):
+
+        try:
+            async with self.client.head(url, allow_redirects=True) as response:
+                if response.status == 200 and 'Content-Length' in response.headers:
+                    return self._parse_meta(response, int(response.headers['Content-Length']))
+
+            async with self.client.get(url, headers={"Range": "bytes=0-0"}) as response:
+                if response.status == 206 and "/" in response.headers.get("Content-Range", ""):
+                    size = response.headers["Content-Range"].split("/")[-1]
+                    if size != "*":
+                        return self._parse_meta(response, int(size))
+                elif response.status == 200 and 'Content-Length' in response.headers:
+                    return self._parse_meta(response, int(response.headers['Content-Length']))
+                LOG.error("Can not get length of %r, status %s." % (url, response.status))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            LOG.error("Can not get length of %r: %s" % (url, e))
+
+        return None
+
+    def _probe(self, url):
+
+        return self._run(self._aprobe(url))
+
+    def probe_all(self, urls, threads=16):
+        """
+        probe urls not cached yet all at once on the event loop
+        :param urls:
+        :param threads: unused, requests are limited by the connection pool
+        :return: OrderedDict {url: meta or None}
+        """
+        todo = [u for u in set(u for url in urls for u in self.mirrors(url)) if u not in self.meta]
+
+        async def probe():
+            return await asyncio.gather(*[self._aprobe(u) for u in todo])
+
+        if todo:
+            for u, meta in zip(todo, self._run(probe())):
+                if meta is not None:
+                    self.meta[u] = meta
+
+        return OrderedDict((u, self.probe(u)) for u in urls)
+
+    async def _fetch(self, mirrors, size, out, callback=None):
+        """
+        GET the whole object from mirrors one by one into out
+        :return: True if size bytes are written
+        """
+        for url in mirrors.urls:
+            if url in mirrors.bad:
+                continue
+            start = time.time()
+            written = 0
+            try:
+                async with self.client.get(url) as response:
+                    if response.status != 200:
+                        raise IOError("Unexpected status %s" % response.status)
+                    validator = mirrors.validators.get(url)
+                    if validator and validator not in (response.headers.get("ETag"),
+                                                       response.headers.get("Last-Modified")):
+                        raise SourceChanged("%s changed since probed" % url)
+                    with open(out, "wb") as fh:
+                        async for chunk in response.content.iter_chunked(self.CHUNK_SIZE):
+                            fh.write(chunk)
+                            written += len(chunk)
+                            if callback is not None:
+                                callback(len(chunk))
+            except SourceChanged:
+                if not mirrors.drop(url):
+                    raise
+                continue
+            except (aiohttp.ClientError, asyncio.TimeoutError, IOError) as e:
+                LOG.warning("Download %r failed: %s" % (url, e))
+                self._retried(url)
+                continue
+
+            mirrors.add(url, written, time.time() - start)
+            if written == size:
+                return True
+            LOG.warning("Download %r got %s bytes, expect %s" % (url, written, size))
+
+        return False
+
+    async def _ameta(self, url):
+        """
+        meta of url like probe, mirrors not cached are probed on the loop,
+        probe must not be called on the loop as it waits on the loop itself
+        """
+        urls = self.mirrors(url)
+        for u in urls:
+            if u not in self.meta:
+                meta = await self._aprobe(u)
+                if meta is not None:
+                    self.meta[u] = meta
+        urls = [u for u in urls if u in self.meta]
+        if not urls:
+            return None
+
+        return self.probe(urls) if isinstance(url, list) else self.meta[url]
+
+    async def _adownload(self, url, out, retry=5, callback=None):
+        """
+        download a small file whole, at most `files` of them at the same time
+        :return: 0 success, 1 failed
+        """
+        async with self.slots:
+            for n in range(retry + 1):
+                meta = await self._ameta(url)
+                if meta is None:
+                    break
+                if n:
+                    await asyncio.sleep(min(2 ** n, 30))
+
+                try:
+                    if await self._fetch(self._mirrors(url, meta), meta["size"], out, callback):
+                        LOG.info("%s download success" % url)
+                        return 0
+                except SourceChanged as e:
+                    LOG.warning("%s, restart download" % e)
+                    for u in self.mirrors(url):
+                        self.meta.pop(u, None)
+
+        if os.path.exists(out):
+            os.remove(out)
+        LOG.error("%s download failed" % url)
+        return 1
+
+    def submit(self, url, out, retry=5, callback=None):
+        """
+        download a small file on the event loop without waiting, see download
+        :return: concurrent.futures.Future of 0 success, 1 failed
+        """
+        if isinstance(url, tuple):
+            url = list(url)
+        self._start()
+
+        return asyncio.run_coroutine_threadsafe(self._adownload(url, out, retry, callback), self.loop)
+
+    def download(self, url, out, retry=5, journal=None, callback=None):
+        """
+        download url to out, small files are fetched whole on the event loop,
+        without resuming, others in ranges by Downloader
+        :param url: an url or a list of mirrors of the same object
+        :param out:
+        :param retry: 重试次数
+        :param journal: Journal, used for large files only
+        :param callback: function called with bytes count of each chunk written
+        :return: 0 success, 1 failed
+        """
+        if isinstance(url, tuple):
+            url = list(url)
+        meta = self.probe(url)
+        if meta is None or meta["size"] > self.small_size:
+            return super(AsyncDownloader, self).download(url, out, retry, journal, callback)
+
+        return self.submit(url, out, retry, callback).result()
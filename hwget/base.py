@@ -1,13 +1,27 @@
 # -*- coding:utf-8 -*-
 
 import os
+import sys
+import shutil
 import time
 import json
 import logging
+import base64
+import hashlib
 import binascii
+import itertools
+import tempfile
+import threading
+import subprocess
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
+from contextlib import contextmanager
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from hwget.version import __version__
+from hwget.compress import output_name
 
 from openstack import connection
 from obs import *
@@ -15,21 +29,298 @@ from obs import *
 LOG = logging.getLogger(__name__)
 
 
+class Checksum(object):
+    """
+    compute checksums incrementally over the transferred bytes
+    """
+    ALGORITHMS = ("md5", "sha256", "crc32c")
+
+    def __init__(self, algorithms=("md5",)):
+        """
+
+        :param algorithms: md5, sha256 or crc32c
+        """
+        self.hashes = OrderedDict()
+        for name in algorithms:
+            if name not in self.ALGORITHMS:
+                raise Exception("Checksum %r not supported, choose from %s" % (name, self.ALGORITHMS))
+            if name == "crc32c":
+                try:
+                    import crcmod.predefined
+                except ImportError:
+                    e = "crcmod is required for crc32c, pip install hwget[crc32c]"
+                    LOG.error(e)
+                    raise Exception(e)
+                self.hashes[name] = crcmod.predefined.Crc("crc-32c")
+            else:
+                self.hashes[name] = hashlib.new(name)
+        self.size = 0
+        self.seconds = 0
+
+    def update(self, data):
+        start = time.time()
+        for h in self.hashes.values():
+            h.update(data)
+        self.size += len(data)
+        self.seconds += time.time() - start
+
+    def hexdigest(self):
+        """
+
+        :return: dict {algorithm: hexdigest}
+        """
+        r = OrderedDict()
+        for name, h in self.hashes.items():
+            r[name] = h.hexdigest().lower()
+
+        return r
+
+
+class Metrics(object):
+    """
+    timings and counters of a task, dumped as json next to its log
+    {
+        "phases": {phase: seconds},
+        "files": {name: {"bytes": 0, "retries": 0, phase: seconds, "MB/s": 0.0}}
+    }
+    counters of an url are kept under the file it is downloaded to, see alias
+    """
+    TRANSFER_PHASES = ("download", "upload", "stream")
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.files = OrderedDict()
+        self.aliases = {}
+        self.lock = threading.Lock()
+
+    def alias(self, name, file):
+
+        with self.lock:
+            self.aliases[name] = file
+
+    def add(self, key, value, name=None):
+        """
+
+        :param key: phase or counter
+        :param value: seconds or count
+        :param name: file, None for the task
+        :return:
+        """
+        with self.lock:
+            if name is None:
+                d = self.phases
+            else:
+                d = self.files.setdefault(self.aliases.get(name, name), OrderedDict())
+            d[key] = d.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, phase, name=None):
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(phase, time.time() - start, name)
+
+    def to_dict(self):
+
+        with self.lock:
+            files = OrderedDict()
+            for name, v in self.files.items():
+                v = OrderedDict(v)
+                seconds = sum(v.get(k, 0) for k in self.TRANSFER_PHASES)
+                if seconds and v.get("bytes"):
+                    v["MB/s"] = round(v["bytes"] / seconds / 1024 / 1024, 2)
+                files[name] = v
+
+            return OrderedDict([("phases", OrderedDict(self.phases)), ("files", files)])
+
+
+class SourceChanged(IOError):
+    """
+    source changed since it was probed, partial data can not be reused
+    """
+
+
+class Journal(object):
+    """
+    crash-safe record of transfer progress, like completed byte ranges,
+    multipart upload_id and part etags, saved atomically as json.
+    a record is only written after the data it describes, so a restart
+    may redo some work but never skips missing data
+    """
+
+    def __init__(self, path, interval=2):
+        """
+
+        :param path: json file
+        :param interval: 两次保存的最小间隔 秒
+        """
+        self.path = path
+        self.interval = interval
+        self.lock = threading.RLock()
+        self.saved = 0
+        self.data = {}
+        if os.path.exists(path):
+            with open(path) as fh:
+                self.data = json.load(fh)
+            LOG.info("Load journal %s with %s records" % (path, len(self.data)))
+
+    def save(self, force=True):
+
+        with self.lock:
+            if not force and time.time() - self.saved < self.interval:
+                return
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as fh:
+                json.dump(self.data, fh)
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp, self.path)
+            self.saved = time.time()
+
+    def get(self, key):
+        """
+
+        :param key:
+        :return: copy of the record, {} if not exists
+        """
+        with self.lock:
+            return json.loads(json.dumps(self.data.get(key, {})))
+
+    def update(self, key, **kwargs):
+
+        with self.lock:
+            self.data.setdefault(key, {}).update(kwargs)
+            self.save()
+
+    def reset(self, key, **kwargs):
+
+        with self.lock:
+            self.data[key] = kwargs
+            self.save()
+
+    def remove(self, key):
+
+        with self.lock:
+            if self.data.pop(key, None) is not None:
+                self.save()
+
+    def add_range(self, key, start, end):
+        """
+        record bytes [start, end) completed, ranges are merged
+        """
+        if end <= start:
+            return
+
+        with self.lock:
+            record = self.data.setdefault(key, {})
+            r = []
+            for s, e in sorted(record.get("ranges", []) + [[start, end]]):
+                if r and s <= r[-1][1]:
+                    r[-1][1] = max(r[-1][1], e)
+                else:
+                    r.append([s, e])
+            record["ranges"] = r
+            self.save(force=False)
+
+    def add_part(self, key, part_num, etag):
+
+        with self.lock:
+            self.data.setdefault(key, {}).setdefault("parts", {})[str(part_num)] = etag
+            self.save(force=False)
+
+
+class Concurrency(object):
+    """
+    AIMD limit of requests in flight, between low and high.
+    after a window of `limit` requests the limit is widened by one if the
+    throughput grew, narrowed by one if it fell, and halved on any error
+    """
+
+    def __init__(self, high, low=1, start=2, tolerance=0.05):
+        """
+
+        :param high: 最大并发
+        :param low: 最小并发
+        :param start: 初始并发
+        :param tolerance: 吞吐变化小于该比例时视为不变
+        """
+        self.high = max(high, 1)
+        self.low = max(min(low, self.high), 1)
+        self.limit = max(min(start, self.high), self.low)
+        self.tolerance = tolerance
+        self.inflight = 0
+        self.rate = 0
+        self.cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.window_count = 0
+
+    def acquire(self):
+
+        with self.cond:
+            while self.inflight >= self.limit:
+                self.cond.wait()
+            self.inflight += 1
+
+    def release(self, size=0):
+        """
+        a request finished
+        :param size: bytes transferred, 0 for a failed request
+        :return:
+        """
+        with self.cond:
+            self.inflight -= 1
+            self.window_bytes += size
+            self.window_count += 1
+            if self.window_count >= self.limit:
+                rate = self.window_bytes / max(time.time() - self.window_start, 1e-6)
+                if rate > self.rate * (1 + self.tolerance):
+                    self.limit = min(self.limit + 1, self.high)
+                elif rate < self.rate * (1 - self.tolerance):
+                    self.limit = max(self.limit - 1, self.low)
+                self.rate = rate
+                self._reset()
+            self.cond.notify_all()
+
+    def failed(self):
+        """
+        an error seen, halve the limit
+        """
+        with self.cond:
+            self.limit = max(self.limit // 2, self.low)
+            self.rate = 0
+            self._reset()
+
+
 class Cloud(object):
     """
     create, search ECS related service
     """
     CLOUD = "myhuaweicloud.com"
+    CACHE_DIR = os.path.join(os.path.expanduser("~"), ".hwget")
 
-    def __init__(self, ak, sk, region, project_id):
+    def __init__(self, ak, sk, region, project_id, cache_file=None, cache_ttl=3600):
         """
 
         :param ak: 账号名
         :param sk: 密码
         :param region: 账号ID
         :param project_id: 项目ID
+        :param cache_file: zone/flavor/vpc 查询结果缓存文件, 默认为 ~/.hwget/cloud_{region}_{project_id}.json
+        :param cache_ttl: 缓存有效期 秒, 0 不使用缓存
         """
         self.connect = self._connect(ak, sk, region, project_id)
+        if cache_file is None:
+            cache_file = os.path.join(self.CACHE_DIR, "cloud_%s_%s.json" % (region, project_id))
+        self.cache_file = cache_file
+        self.cache_ttl = cache_ttl
+        self.cache_lock = threading.RLock()
+        self.cache = self._load_cache()
 
     def _connect(self, ak, sk, region, project_id):
 
@@ -51,6 +342,64 @@ class Cloud(object):
 
         return conn
 
+    def _load_cache(self):
+
+        if not os.path.exists(self.cache_file):
+            return {}
+
+        try:
+            with open(self.cache_file) as fh:
+                return json.load(fh)
+        except (IOError, ValueError) as e:
+            LOG.warning("Ignore broken cache %s: %s" % (self.cache_file, e))
+            return {}
+
+    def _save_cache(self):
+
+        folder = os.path.dirname(self.cache_file)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        tmp = self.cache_file + ".tmp"
+        with open(tmp, "w") as fh:
+            json.dump(self.cache, fh)
+        os.replace(tmp, self.cache_file)
+
+    def _cached(self, name, fetch):
+        """
+        value of name in cache, fetch and save it if missing or expired
+        :param name:
+        :param fetch: function without arguments
+        :return:
+        """
+        with self.cache_lock:
+            item = self.cache.get(name)
+            if item and time.time() - item["time"] < self.cache_ttl:
+                return item["value"]
+
+        value = fetch()
+        with self.cache_lock:
+            self.cache[name] = {"time": time.time(), "value": value}
+            if self.cache_ttl:
+                self._save_cache()
+
+        return value
+
+    def clear_cache(self):
+
+        with self.cache_lock:
+            self.cache = {}
+            if os.path.exists(self.cache_file):
+                os.remove(self.cache_file)
+
+    def warm(self):
+        """
+        fetch zones, flavors, vpc and subnet into cache concurrently
+        :return:
+        """
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            for f in [self.zone_flavors, lambda: self.vpc, lambda: self.subnet]:
+                executor.submit(f)
+
     @property
     def vpc(self):
         """
@@ -58,7 +407,7 @@ class Cloud(object):
         :return: dict vpc {name: id}
         """
 
-        r = {i.name: i.id for i in self.connect.vpcv1.vpcs()}
+        r = self._cached("vpc", lambda: {i.name: i.id for i in self.connect.vpcv1.vpcs()})
         LOG.info("VPC: %s" % r)
 
         return r
@@ -70,7 +419,7 @@ class Cloud(object):
         :return: dict subnet {name: id}
         """
 
-        r = {i.name: i.id for i in self.connect.vpcv1.subnets()}
+        r = self._cached("subnet", lambda: {i.name: i.id for i in self.connect.vpcv1.subnets()})
         LOG.info("Subnet: %s" % r)
 
         return r
@@ -96,6 +445,19 @@ class Cloud(object):
         LOG.info("Flavors in %s: %s" % (zone, r))
         return r
 
+    def _fetch_zone_flavors(self):
+
+        zones = self.available_zones()
+        with ThreadPoolExecutor(max_workers=max(len(zones), 1)) as executor:
+            return OrderedDict(zip(zones, executor.map(self.available_flavors, zones)))
+
+    def zone_flavors(self):
+        """
+        region下每个zone可用实例, 查询结果缓存
+        :return: dict {zone: [flavor]}
+        """
+        return self._cached("zone_flavors", self._fetch_zone_flavors)
+
     def get_zone_has_flavor(self, flavor):
         """
         实例名查询可用zone
@@ -103,15 +465,15 @@ class Cloud(object):
         :return: zone or None
         """
         LOG.info("Looking for zone has flavor %r" % flavor)
-        for zone in self.available_zones():
-            if flavor in self.available_flavors(zone):
+        for zone, flavors in self.zone_flavors().items():
+            if flavor in flavors:
                 LOG.info(zone)
                 return zone
 
         LOG.info("Not found")
         return None
 
-    def create_service(self, name, flavor, root_gb, image, personality, user_data):
+    def create_service(self, name, flavor, root_gb, image, personality, user_data, zone=None):
         """
         创建ECS服务器
         :param name: 名称
@@ -120,15 +482,17 @@ class Cloud(object):
         :param image: 镜像ID
         :param personality: personality属性 {"path": "", "content": ""}
         :param user_data: user_data
+        :param zone: 可用区, 默认查询有该实例的zone
         :return: server id
         """
 
         content = binascii.b2a_base64(personality["content"].encode())[:-1].decode("utf-8")
         user_data = binascii.b2a_base64(user_data.encode())[:-1].decode("utf-8")
-        zone = self.get_zone_has_flavor(flavor)
+        if zone is None:
+            zone = self.get_zone_has_flavor(flavor)
 
         if zone is None:
-            e = "Flavor %r not found."
+            e = "Flavor %r not found." % flavor
             LOG.error(e)
             raise Exception(e)
 
@@ -264,19 +628,29 @@ class OBS(object):
     work with obs storage
     """
     OBS_URL_PATTERN = "https://obs.{region}.myhuaweicloud.com/"
-
-    def __init__(self, ak, sk, region):
+    MAX_PARTS = 10000
+    PART_SIZE = 20*1024*1024
+    MIN_PART_SIZE = 5*1024*1024
+    MAX_PART_SIZE = 5*1024*1024*1024
+    # objects not larger than PUT_SIZE are put in one request instead of a multipart upload
+    PUT_SIZE = 5*1024*1024
+    FETCH_PART_SIZE = 16*1024*1024
+
+    def __init__(self, ak, sk, region, server=None):
         """
 
         :param ak:
         :param sk:
         :param region:
+        :param server: endpoint, default: OBS endpoint of region
         """
         self.region = region
-        self.connect = self._connect(ak, sk, region)
+        self.connect = self._connect(ak, sk, region, server)
+        self.metrics = None
 
-    def _connect(self, ak, sk, region):
-        server = self.OBS_URL_PATTERN.format(region=region)
+    def _connect(self, ak, sk, region, server=None):
+        if server is None:
+            server = self.OBS_URL_PATTERN.format(region=region)
         return ObsClient(access_key_id=ak, secret_access_key=sk, server=server)
 
     def mkdir(self, bucket, folder):
@@ -293,35 +667,251 @@ class OBS(object):
 
         return folder
 
+    def iter_objects(self, bucket, prefix, marker=None, max_keys=1000):
+        """
+        list objects under prefix page by page
+        :param bucket:
+        :param prefix:
+        :param marker: list keys after marker
+        :param max_keys: 每页数量
+        :return: generator of (key, {"etag": str, "size": int})
+        """
+        while True:
+            resp = self.connect.listObjects(bucket, prefix=prefix, marker=marker, max_keys=max_keys)
+            if resp.status >= 300:
+                LOG.error(resp.header)
+                raise Exception(resp.header)
+
+            contents = resp.body.contents or []
+            for content in contents:
+                yield content.key, {"etag": content.etag, "size": content.size}
+
+            if not resp.body.is_truncated or not contents:
+                break
+            marker = resp.body.next_marker or contents[-1].key
+
     def ls(self, bucket, folder):
 
-        resp = self.connect.listObjects(bucket, prefix=folder)
-        if resp.status < 300:
-            r = OrderedDict()
-            for content in resp.body.contents:
-                r[content.key] = {"etag": content.etag, "size": content.content_length}
+        r = OrderedDict(self.iter_objects(bucket, folder))
+        LOG.info("%s objects in %s/%s" % (len(r), bucket, folder))
+
+        return r
 
-            LOG.info(r)
+    def stat(self, bucket, target):
+        """
+
+        :param bucket:
+        :param target:
+        :return: dict {"size": int, "etag": str} or None if not exists
+        """
+        resp = self.connect.getObjectMetadata(bucket, target)
+        if resp.status < 300:
+            return {"size": resp.body.contentLength, "etag": resp.body.etag}
+        elif resp.status == 404:
+            return None
         else:
-            LOG.error(resp.header)
-            raise Exception(resp.header)
+            e = "Stat %r error. %s" % (target, resp.errorMessage)
+            LOG.error(e)
+            raise Exception(e)
 
-        return r
+    def stat_many(self, bucket, targets, threads=16):
+        """
+        stat objects concurrently
+        :return: OrderedDict {target: stat or None}
+        """
+        with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+            return OrderedDict(zip(targets, executor.map(lambda t: self.stat(bucket, t), targets)))
 
-    def _upload(self, bucket, object_name, part_num, upload_id, file_path, part_size, offset):
+    @classmethod
+    def part_size_for(cls, size, part_size=None, threads=1):
+        """
+        choose the part size of an object of size, MiB aligned and large
+        enough to stay within MAX_PARTS parts
+        :param size: object size, None if unknown
+        :param part_size: preferred part size, default PART_SIZE, or smaller for
+                          small objects so all threads have a part to upload
+        :param threads:
+        :return: part size
+        """
+        mib = 1024*1024
+        if part_size is None:
+            part_size = cls.PART_SIZE
+            if size is not None and threads > 1:
+                part_size = min(part_size, max(-(-size // (threads * mib)) * mib, cls.MIN_PART_SIZE))
+
+        if size is not None:
+            part_size = max(part_size, -(-size // (cls.MAX_PARTS * mib)) * mib)
+        if part_size > cls.MAX_PART_SIZE:
+            e = "Size %s exceeds %s parts of %s bytes" % (size, cls.MAX_PARTS, cls.MAX_PART_SIZE)
+            LOG.error(e)
+            raise Exception(e)
 
-        response = self.connect.uploadPart(
-            bucket, object_name, part_num, upload_id, content=file_path, partSize=part_size, offset=offset,
-            isFile=True, isAttachMd5=True)
+        return part_size
 
-        if response.status < 300:
-            etag = response.body.etag
-            LOG.info("%r part%s %s-%s success, etag: %s." % (file_path, part_size, part_size + offset, part_num, etag))
-            return etag
-        else:
-            LOG.info("%r part%s %s-%s failed." % (file_path, part_size, part_size + offset, part_num))
-            LOG.error(response.errorMessage)
-            return None
+    def _upload(self, bucket, object_name, part_num, upload_id, data, offset, retry=3, concurrency=None):
+        """
+        upload one part with its md5, retry with backoff
+        :param data: bytes of the part
+        :param offset: offset of the part in object, for log
+        :param concurrency: Concurrency told about each error
+        :return: etag
+        """
+        md5 = base64.b64encode(hashlib.md5(data).digest()).decode("utf-8")
+        end = offset + len(data)
+
+        for n in range(retry + 1):
+            if n:
+                if self.metrics is not None:
+                    self.metrics.add("retries", 1, object_name)
+                if concurrency is not None:
+                    concurrency.failed()
+                time.sleep(min(2 ** n, 30))
+
+            try:
+                response = self.connect.uploadPart(bucket, object_name, part_num, upload_id, content=data, md5=md5)
+            except Exception as e:
+                LOG.warning("%r part%s %s-%s error: %s" % (object_name, part_num, offset, end, e))
+                continue
+
+            if response.status < 300:
+                etag = response.body.etag
+                LOG.info("%r part%s %s-%s success, etag: %s." % (object_name, part_num, offset, end, etag))
+                return etag
+            else:
+                LOG.warning("%r part%s %s-%s failed. %s" % (object_name, part_num, offset, end, response.errorMessage))
+
+        e = "%r part%s upload failed after %s tries." % (object_name, part_num, retry + 1)
+        LOG.error(e)
+        raise Exception(e)
+
+    def _put(self, bucket, target, data, retry=3):
+        """
+        put a small object with its md5 in one request, retry with backoff
+        :param data: bytes of the object
+        :return: etag
+        """
+        headers = PutObjectHeader(md5=base64.b64encode(hashlib.md5(data).digest()).decode("utf-8"))
+
+        for n in range(retry + 1):
+            if n:
+                if self.metrics is not None:
+                    self.metrics.add("retries", 1, target)
+                time.sleep(min(2 ** n, 30))
+
+            try:
+                response = self.connect.putContent(bucket, target, content=data, headers=headers)
+            except Exception as e:
+                LOG.warning("Put %r error: %s" % (target, e))
+                continue
+
+            if response.status < 300:
+                LOG.info("Put %r success, %s bytes." % (target, len(data)))
+                return response.body.etag
+            else:
+                LOG.warning("Put %r failed. %s" % (target, response.errorMessage))
+
+        e = "Put %r failed after %s tries." % (target, retry + 1)
+        LOG.error(e)
+        raise Exception(e)
+
+    def list_parts(self, bucket, target, upload_id):
+        """
+        parts uploaded of a multipart upload
+        :return: dict {part_num: (etag, size)}
+        """
+        r = {}
+        marker = None
+        while True:
+            resp = self.connect.listParts(bucket, target, upload_id, partNumberMarker=marker)
+            if resp.status >= 300:
+                e = "listParts %r %s error. %s" % (target, upload_id, resp.errorMessage)
+                LOG.error(e)
+                raise Exception(e)
+            for part in resp.body.parts or []:
+                r[part.partNumber] = (part.etag, part.size)
+            if not resp.body.isTruncated:
+                break
+            marker = resp.body.nextPartNumberMarker
+
+        return r
+
+    def _upload_parts(self, bucket, target, upload_id, chunks, part_size, threads, retry, checksum=None,
+                      uploaded=None, journal=None, callback=None):
+        """
+        cut chunks into parts and upload them, parts in flight are adapted
+        between 1 and threads by Concurrency, no more than threads + 1
+        parts are held in memory
+        :param chunks: iterable of bytes
+        :param checksum: Checksum updated with all bytes in order
+        :param uploaded: dict {part_num: (etag, size)} uploaded already, parts of the same size and md5 are skipped
+        :param journal: Journal to record part etags of target
+        :param callback: function called with bytes count of each part uploaded
+        :return: list CompletePart
+        """
+        slots = Concurrency(threads)
+        uploaded = uploaded or {}
+        futures = []
+
+        def record(part_num, size, future):
+            if future.exception():
+                slots.release()
+                return
+            slots.release(size)
+            if journal is not None:
+                journal.add_part(target, part_num, future.result())
+            if callback is not None:
+                callback(size)
+
+        def submit(executor, data):
+            part_num = len(futures) + 1
+            if part_num > self.MAX_PARTS:
+                raise Exception('Total parts count should not exceed %s' % self.MAX_PARTS)
+            for future in futures:
+                if future.done() and future.exception():
+                    raise future.exception()
+            if checksum is not None:
+                checksum.update(data)
+            if part_num in uploaded and uploaded[part_num][1] == len(data) and \
+                    (uploaded[part_num][0] or "").strip('"') == hashlib.md5(data).hexdigest():
+                future = Future()
+                future.set_result(uploaded[part_num][0])
+                futures.append(future)
+                if callback is not None:
+                    callback(len(data))
+                return
+            size = len(data)
+            slots.acquire()
+            future = executor.submit(self._upload, bucket, target, part_num, upload_id, data,
+                                     (part_num - 1) * part_size, retry, slots)
+            # capture only the size, the future outlives the part bytes
+            future.add_done_callback(lambda f: record(part_num, size, f))
+            futures.append(future)
+
+        with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+            buf = bytearray()
+            for chunk in chunks:
+                if not buf and len(chunk) == part_size:
+                    submit(executor, chunk)
+                    continue
+                buf += chunk
+                while len(buf) >= part_size:
+                    submit(executor, bytes(buf[:part_size]))
+                    del buf[:part_size]
+
+            if buf or not futures:
+                submit(executor, bytes(buf))
+
+        LOG.info("%r uploaded in %s parts, %s in flight at last" % (target, len(futures), slots.limit))
+        return [CompletePart(partNum=i + 1, etag=f.result()) for i, f in enumerate(futures)]
+
+    @staticmethod
+    def _read(file, part_size):
+        with open(file, "rb") as fh:
+            while True:
+                data = fh.read(part_size)
+                if not data:
+                    break
+                yield data
 
     def put(self, bucket, target, content):
 
@@ -341,110 +931,1320 @@ class OBS(object):
 
         return 0
 
-    def upload(self, bucket, target, file, part_size=20*1024*1024):
+    def upload(self, bucket, target, file, part_size=None, threads=4, retry=3, checksum=None, journal=None,
+               callback=None):
         """
-
+        the file is read only once, parts and checksum are computed from
+        the same bytes. a file not larger than PUT_SIZE is put in one request
         :param bucket:
         :param file:
         :param target:
-        :param part_size:
-        :return:
+        :param part_size: 默认按文件大小选择, 见 part_size_for
+        :param threads: 同时上传的最大分段数
+        :param retry: 每个分段的重试次数
+        :param checksum: Checksum of the whole file
+        :param journal: Journal, resume the multipart upload recorded for target
+        :param callback: function called with bytes count of each part uploaded
+        :return: target, raise Exception if failed
         """
         LOG.info("Upload %r to %r" % (file, (bucket + "/" + target)))
-        resp = self.connect.initiateMultipartUpload(bucket, target)
-        if resp.status >= 300:
-            LOG.error('initiateMultipartUpload failed')
-            return 1
-        upload_id = resp.body.uploadId
-
         file_size = os.path.getsize(file)
         LOG.info("File size: %s Gb" % (file_size/1024/1024/1024))
-        part_num = int(file_size / part_size) if (file_size % part_size == 0) else int(file_size / part_size) + 1
-        LOG.info("%r split into %s parts to upload" % (file, part_num))
-        if part_num > 10000:
-            LOG.error('Total parts count should not exceed 10000')
-            return 1
+        if file_size <= self.PUT_SIZE:
+            with open(file, "rb") as fh:
+                data = fh.read()
+            if checksum is not None:
+                checksum.update(data)
+            self._put(bucket, target, data, retry)
+            if callback is not None:
+                callback(len(data))
+            return target
+
+        part_size = self.part_size_for(file_size, part_size, threads)
+        part_num = max(-(-file_size // part_size), 1)
+        LOG.info("%r split into %s parts of %s bytes to upload" % (file, part_num, part_size))
+
+        upload_id = None
+        uploaded = {}
+        record = journal.get(target) if journal is not None else {}
+        if record.get("upload_id") and record.get("size") == file_size and record.get("part_size") == part_size:
+            try:
+                uploaded = self.list_parts(bucket, target, record["upload_id"])
+                upload_id = record["upload_id"]
+                LOG.info("Resume upload %s of %r, %s parts uploaded" % (upload_id, target, len(uploaded)))
+            except Exception as e:
+                LOG.warning("Can not resume upload %s of %r: %s" % (record["upload_id"], target, e))
+
+        if upload_id is None:
+            resp = self.connect.initiateMultipartUpload(bucket, target)
+            if resp.status >= 300:
+                e = "initiateMultipartUpload %r failed. %s" % (target, resp.errorMessage)
+                LOG.error(e)
+                raise Exception(e)
+            upload_id = resp.body.uploadId
+            if journal is not None:
+                journal.reset(target, upload_id=upload_id, size=file_size, part_size=part_size)
+
+        try:
+            parts = self._upload_parts(
+                bucket, target, upload_id, self._read(file, part_size), part_size, threads, retry, checksum,
+                uploaded, journal, callback)
+        except Exception:
+            if journal is not None:
+                LOG.error("Upload %r failed, keep upload %s to resume." % (target, upload_id))
+                journal.save()
+            else:
+                LOG.error("Upload %r failed, abort upload %s." % (target, upload_id))
+                self.connect.abortMultipartUpload(bucket, target, upload_id)
+            raise
+
+        resp = self.connect.completeMultipartUpload(bucket, target, upload_id, CompleteMultipartUploadRequest(parts))
+        if resp.status >= 300:
+            e = "completeMultipartUpload %r failed. %s" % (target, resp.errorMessage)
+            LOG.error(e)
+            if journal is not None:
+                journal.save()
+            else:
+                self.connect.abortMultipartUpload(bucket, target, upload_id)
+            raise Exception(e)
 
-        etag_dict = {}
-        for i in range(part_num):
-            offset = i * part_size
-            curr_size = (file_size - offset) if i + 1 == part_num else part_size
-            etag = self._upload(bucket, target, i + 1, upload_id, file, curr_size, offset)
-            if etag is not None:
-                etag_dict[i + 1] = etag
+        LOG.info('Upload to %s success.' % target)
+        if journal is not None:
+            journal.remove(target)
+        return target
 
-        parts = []
+    def upload_stream(self, bucket, target, chunks, part_size=None, threads=4, retry=3, checksum=None,
+                      callback=None, size=None):
+        """
+        upload an iterable of bytes as multipart object, content not larger
+        than PUT_SIZE is put in one request
+        :param bucket:
+        :param target:
+        :param chunks: iterable of bytes, like Downloader.stream
+        :param part_size: 默认按 size 选择, 见 part_size_for
+        :param threads: 同时上传的最大分段数
+        :param retry: 每个分段的重试次数
+        :param checksum: Checksum of the whole content
+        :param callback: function called with bytes count of each part uploaded
+        :param size: content size if known
+        :return: target
+        """
+        LOG.info("Upload stream to %r" % (bucket + "/" + target))
+        if size is None or size <= self.PUT_SIZE:
+            chunks = iter(chunks)
+            head = bytearray()
+            for chunk in chunks:
+                head += chunk
+                if len(head) > self.PUT_SIZE:
+                    break
+            else:
+                if checksum is not None:
+                    checksum.update(bytes(head))
+                self._put(bucket, target, bytes(head), retry)
+                if callback is not None:
+                    callback(len(head))
+                return target
+            chunks = itertools.chain([bytes(head)], chunks)
+
+        part_size = self.part_size_for(size, part_size, threads)
+        resp = self.connect.initiateMultipartUpload(bucket, target)
+        if resp.status >= 300:
+            e = "initiateMultipartUpload %r failed" % target
+            LOG.error(e)
+            raise Exception(e)
+        upload_id = resp.body.uploadId
 
-        for k, v in sorted(etag_dict.items(), key=lambda d: d[0]):
-            parts.append(CompletePart(partNum=k, etag=v))
+        try:
+            parts = self._upload_parts(bucket, target, upload_id, chunks, part_size, threads, retry, checksum,
+                                       callback=callback)
+        except Exception:
+            LOG.error("Upload %r failed, abort upload %s." % (target, upload_id))
+            self.connect.abortMultipartUpload(bucket, target, upload_id)
+            raise
 
         resp = self.connect.completeMultipartUpload(bucket, target, upload_id, CompleteMultipartUploadRequest(parts))
-        if resp.status < 300:
-            LOG.info('Upload to %s success.' % target)
-            return target
-        else:
-            return None
+        if resp.status >= 300:
+            e = "completeMultipartUpload %r failed. %s" % (target, resp.errorMessage)
+            LOG.error(e)
+            raise Exception(e)
 
-    def download(self, bucket, target, file):
+        LOG.info('Upload to %s success.' % target)
+        return target
 
-        resp = self.connect.getObject(bucket, target, downloadPath=file)
+    def create(self, bucket, target, content):
+        """
+        create an object only if it does not exist, an append at position 0
+        fails on an existing object, so only one caller can win
+        :param bucket:
+        :param target:
+        :param content: not empty
+        :return: True if created, False if exists
+        """
+        resp = self.connect.appendObject(bucket, target, content=AppendObjectContent(content=content, position=0))
         if resp.status < 300:
-            LOG.info("Download %r success." % target)
+            return True
+        elif resp.status == 409:
+            return False
         else:
-            e = "Download %r error. %s" % (target, resp.errorMessage)
+            e = "Create %r error. %s" % (target, resp.errorMessage)
             LOG.error(e)
             raise Exception(e)
 
-        return file
+    def copy(self, src_bucket, src_key, bucket, target, size, threads=4):
+        """
+        copy an object inside OBS, objects larger than MAX_PART_SIZE are
+        copied part by part
+        :param src_bucket:
+        :param src_key:
+        :param bucket:
+        :param target:
+        :param size: size of the source object
+        :param threads: 同时复制的分段数
+        :return: target
+        """
+        if size <= self.MAX_PART_SIZE:
+            resp = self.connect.copyObject(src_bucket, src_key, bucket, target)
+            if resp.status >= 300:
+                e = "Copy %r to %r error. %s" % (src_key, target, resp.errorMessage)
+                LOG.error(e)
+                raise Exception(e)
+            LOG.info("Copy %s/%s to %s/%s success." % (src_bucket, src_key, bucket, target))
+            return target
+
+        part_size = self.part_size_for(size, min(1024*1024*1024, self.MAX_PART_SIZE))
+        resp = self.connect.initiateMultipartUpload(bucket, target)
+        if resp.status >= 300:
+            e = "initiateMultipartUpload %r failed" % target
+            LOG.error(e)
+            raise Exception(e)
+        upload_id = resp.body.uploadId
 
+        def copy_part(part_num):
+            start = (part_num - 1) * part_size
+            end = min(start + part_size, size)
+            r = self.connect.copyPart(bucket, target, part_num, upload_id, "%s/%s" % (src_bucket, src_key),
+                                      "%s-%s" % (start, end - 1))
+            if r.status >= 300:
+                raise Exception("Copy %r part%s error. %s" % (target, part_num, r.errorMessage))
+            return CompletePart(partNum=part_num, etag=r.body.etag)
 
-class Downloader(object):
+        try:
+            with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+                parts = list(executor.map(copy_part, range(1, -(-size // part_size) + 1)))
+            resp = self.connect.completeMultipartUpload(bucket, target, upload_id,
+                                                        CompleteMultipartUploadRequest(parts))
+            if resp.status >= 300:
+                raise Exception("completeMultipartUpload %r failed. %s" % (target, resp.errorMessage))
+        except Exception as e:
+            LOG.error("Copy %r failed, abort upload %s. %s" % (target, upload_id, e))
+            self.connect.abortMultipartUpload(bucket, target, upload_id)
+            raise
 
-    HEADER = {
-        'User-Agent': 'user-agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.132 Safari/537.36'
-    }
+        LOG.info("Copy %s/%s to %s/%s in %s parts success." % (src_bucket, src_key, bucket, target, len(parts)))
+        return target
 
-    def _download(self, url, start, end, out):
+    def delete(self, bucket, target):
 
-        header = self.HEADER.update({"Range": "bytes=%s-%s" % (start, end)})
-        response = requests.get(url, headers=header, stream=True)
-        LOG.info("Download %r from %s to %s" % (url, start, end))
-        with open(out, 'ab') as fh:
-            for chunk in response.iter_content(chunk_size=1024*1024):
-                if chunk:
-                    fh.write(chunk)
+        resp = self.connect.deleteObject(bucket, target)
+        if resp.status >= 300 and resp.status != 404:
+            e = "Delete %r error. %s" % (target, resp.errorMessage)
+            LOG.error(e)
+            raise Exception(e)
 
         return 0
 
-    def download(self, url, out, retry=5):
+    def sign(self, bucket, target, expires=3600):
+        """
+        a temporary url to get the object without credentials
+        :param bucket:
+        :param target:
+        :param expires: seconds
+        :return: url
+        """
+        return self.connect.createSignedUrl("GET", bucket, target, expires=expires).signedUrl
 
-        response = requests.get(url, headers=self.HEADER, stream=True)
-        file_size = int(response.headers['content-length'])
+    def get(self, bucket, target, start=None, end=None):
+        """
+        read a small object into memory
+        :param bucket:
+        :param target:
+        :param start: first byte of a range
+        :param end: last byte of a range, included
+        :return: bytes or None if not exists
+        """
+        headers = GetObjectHeader(range="%s-%s" % (start, end)) if start is not None else None
+        resp = self.connect.getObject(bucket, target, headers=headers, loadStreamInMemory=True)
+        if resp.status < 300:
+            return resp.body.buffer
+        elif resp.status == 404:
+            return None
+        else:
+            e = "Get %r error. %s" % (target, resp.errorMessage)
+            LOG.error(e)
+            raise Exception(e)
 
-        LOG.info("Download %r to %s" % (url, out))
-        n = 0
-        while True:
-            if os.path.exists(out):
-                download_size = os.path.getsize(out)
+    def _get_range(self, bucket, target, start, end, etag=None, retry=3):
+        """
+        bytes [start, end) of target, retry with backoff
+        :param etag: If-Match, SourceChanged is raised if the object changed
+        :return: bytes
+        """
+        # the SDK url encodes header values, so the etag is sent without quotes
+        headers = GetObjectHeader(range="%s-%s" % (start, end - 1), if_match=etag.strip('"') if etag else None)
+
+        for n in range(retry + 1):
+            if n:
+                if self.metrics is not None:
+                    self.metrics.add("retries", 1, target)
+                time.sleep(min(2 ** n, 30))
+
+            try:
+                resp = self.connect.getObject(bucket, target, headers=headers, loadStreamInMemory=True)
+            except Exception as e:
+                LOG.warning("Get %r %s-%s error: %s" % (target, start, end, e))
+                continue
+
+            if resp.status == 412:
+                raise SourceChanged("%s changed since listed" % target)
+            elif resp.status >= 300:
+                LOG.warning("Get %r %s-%s failed. %s" % (target, start, end, resp.errorMessage))
+            elif len(resp.body.buffer) != end - start:
+                LOG.warning("Get %r %s-%s got %s bytes" % (target, start, end, len(resp.body.buffer)))
             else:
-                download_size = 0
+                return resp.body.buffer
 
-            if download_size >= file_size:
-                LOG.info("%s download success" % url)
-                return 0
+        e = "Get %r %s-%s failed after %s tries." % (target, start, end, retry + 1)
+        LOG.error(e)
+        raise Exception(e)
 
-            if n >= retry:
-                LOG.error("%s download failed" % url)
-                return 1
+    def fetch_object(self, bucket, target, file, size, etag=None, threads=4, part_size=FETCH_PART_SIZE, retry=3,
+                     journal=None):
+        """
+        download an object with ranged GETs on threads into a preallocated
+        file, each range is flushed before it is recorded in journal
+        :param size: object size
+        :param etag: object etag, ranges of another version are not reused
+        :param threads: 同时下载的分段数
+        :param part_size: 每段字节数
+        :param journal: Journal, resume from the ranges recorded for file
+        :return: file
+        """
+        record = journal.get(file) if journal is not None else {}
+        done = []
+        if record.get("target") == target and record.get("etag") == etag and record.get("size") == size and \
+                os.path.exists(file) and os.path.getsize(file) == size:
+            done = record.get("ranges", [])
+            LOG.info("Resume %r to %s, ranges done: %s" % (target, file, done))
+        else:
+            if journal is not None:
+                journal.reset(file, target=target, etag=etag, size=size)
+            folder = os.path.dirname(file)
+            if folder and not os.path.isdir(folder):
+                os.makedirs(folder)
+            with open(file, "wb") as fh:
+                if size and hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(fh.fileno(), 0, size)
+                else:
+                    fh.truncate(size)
+
+        ranges = [(s, min(s + part_size, size)) for s in range(0, size, part_size)]
+        ranges = [(s, e) for s, e in ranges if not any(a <= s and e <= b for a, b in done)]
+
+        def get(item):
+            start, end = item
+            data = self._get_range(bucket, target, start, end, etag, retry)
+            with open(file, "r+b") as fh:
+                fh.seek(start)
+                fh.write(data)
+                fh.flush()
+                os.fsync(fh.fileno())
+            if journal is not None:
+                journal.add_range(file, start, end)
 
-            self._download(url, download_size, file_size, out)
+        try:
+            with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+                list(executor.map(get, ranges))
+        finally:
+            # ranges are saved lazily, keep them to resume
+            if journal is not None:
+                journal.save()
 
-            n += 1
+        return file
 
+    def fetch(self, bucket, folder, dest, threads=4, files=4, part_size=FETCH_PART_SIZE, verify=True):
+        """
+        download objects under folder to dest, several objects at the same
+        time, each with ranged GETs, see fetch_object. progress is kept in
+        {dest}/.hwget.journal, so a second run resumes and skips the files
+        done. files listed in the md5 manifests are verified at last
+        :param bucket:
+        :param folder: date/uid
+        :param dest: 本地目录
+        :param threads: 单个对象同时下载的分段数
+        :param files: 同时下载的对象数
+        :param part_size: 每段字节数
+        :param verify: 按 .md5 清单校验
+        :return: list keys failed and files not matching the manifests
+        """
+        prefix = folder.rstrip("/") + "/"
+        if not os.path.isdir(dest):
+            os.makedirs(dest)
+        journal = Journal(os.path.join(dest, ".hwget.journal"))
+        objects = [(k, s) for k, s in self.iter_objects(bucket, prefix) if not k.endswith("/")]
+        LOG.info("Fetch {:,} objects of {:,} bytes from {:}".format(
+            len(objects), sum(s["size"] for k, s in objects), prefix))
+
+        def fetch(item):
+            key, stat = item
+            file = os.path.join(dest, key[len(prefix):])
+            record = journal.get(file)
+            if record.get("done") and record.get("etag") == stat["etag"] and \
+                    os.path.exists(file) and os.path.getsize(file) == stat["size"]:
+                LOG.info("%r fetched already" % key)
+                return None
+            start = time.time()
+            try:
+                self.fetch_object(bucket, key, file, stat["size"], stat["etag"], threads, part_size,
+                                  journal=journal)
+            except Exception as e:
+                LOG.error("Fetch %r failed: %s" % (key, e))
+                return key
+            journal.update(file, done=True)
+            LOG.info("Fetch %r in %.1fs, %.1f MB/s" % (
+                key, time.time() - start, stat["size"] / 1024 / 1024 / max(time.time() - start, 1e-3)))
+            return None
 
-class Hwget(object):
+        with ThreadPoolExecutor(max_workers=max(files, 1)) as executor:
+            failed = [k for k in executor.map(fetch, objects) if k is not None]
 
-    def __init__(self, ak, sk, region, project_id, bucket, image="dbe9b51f-b64e-4373-a9d5-446885156ebf"):
+        if verify:
+            manifests = [os.path.join(dest, k[len(prefix):]) for k, s in objects
+                         if k.endswith(".md5") and k not in failed]
+            failed += self.verify(dest, manifests, files, skip=[k[len(prefix):] for k in failed])
+
+        if failed:
+            LOG.error("%s files failed: %s" % (len(failed), failed))
+        else:
+            LOG.info("All files fetched to %s" % dest)
+        return failed
+
+    @staticmethod
+    def local_packs(dest):
+        """
+        files packed into tar shards fetched to dest, from the index next to each shard
+        :param dest: 本地目录
+        :return: dict {out: (shard path, offset, size)}
+        """
+        r = {}
+        folder = os.path.join(dest, "packs")
+        if not os.path.isdir(folder):
+            return r
+        for name in os.listdir(folder):
+            if not name.endswith(".tar.idx"):
+                continue
+            with open(os.path.join(folder, name)) as fh:
+                for line in fh:
+                    if line.strip():
+                        out, offset, size = line.rstrip("\n").split("\t")
+                        r[out] = (os.path.join(folder, name[:-len(".idx")]), int(offset), int(size))
+
+        return r
+
+    @staticmethod
+    def verify(dest, manifests, threads=4, skip=()):
+        """
+        check files in dest against md5 manifests, a packed file is checked in its shard by the index,
+        lines of other files not in dest are skipped and counted, like the original names of compressed files
+        :param dest:
+        :param manifests: local files of "md5\tout" lines
+        :param threads: 同时校验的文件数
+        :param skip: files not to check, like those failed to download
+        :return: list files not matching
+        """
+        expected = OrderedDict()
+        for manifest in manifests:
+            with open(manifest) as fh:
+                for line in fh:
+                    if line.strip():
+                        value, out = line.rstrip("\n").split("\t", 1)
+                        if out not in skip:
+                            expected[out] = value
+        packed = OBS.local_packs(dest)
+
+        def check(item):
+            """
+            :return: "checked", "packed", "skipped" or "failed"
+            """
+            out, value = item
+            path = os.path.join(dest, out)
+            checksum = Checksum(["md5"])
+            if os.path.isfile(path):
+                state = "checked"
+                with open(path, "rb") as fh:
+                    for data in iter(lambda: fh.read(Downloader.CHUNK_SIZE), b""):
+                        checksum.update(data)
+            elif out in packed and os.path.isfile(packed[out][0]):
+                state = "packed"
+                path, offset, size = packed[out]
+                with open(path, "rb") as fh:
+                    fh.seek(offset)
+                    while size:
+                        data = fh.read(min(size, Downloader.CHUNK_SIZE))
+                        if not data:
+                            break
+                        checksum.update(data)
+                        size -= len(data)
+            else:
+                return "skipped"
+            if checksum.hexdigest()["md5"] != value:
+                LOG.error("%s md5 %s, expect %s" % (out, checksum.hexdigest()["md5"], value))
+                return "failed"
+            return state
+
+        with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+            states = list(executor.map(check, expected.items()))
+        failed = [out for out, state in zip(expected, states) if state == "failed"]
+        LOG.info("Verify %s files, %s in tar shards, %s failed, %s not in %s skipped" % (
+            len(expected) - states.count("skipped"), states.count("packed"), len(failed), states.count("skipped"),
+            dest))
+
+        return failed
+
+    def download(self, bucket, target, file):
+
+        resp = self.connect.getObject(bucket, target, downloadPath=file)
+        if resp.status < 300:
+            LOG.info("Download %r success." % target)
+        else:
+            e = "Download %r error. %s" % (target, resp.errorMessage)
+            LOG.error(e)
+            raise Exception(e)
+
+        return file
+
+
+class DedupIndex(object):
+    """
+    index of downloaded sources in bucket, {prefix}{sha1 of url, size and
+    validator} holds the object key and checksums, so a source downloaded
+    before is copied inside OBS instead of downloaded again
+    {"url": url, "size": 0, "validator": etag or last modified, "key": key, "checksums": {algorithm: hexdigest}}
+    """
+
+    def __init__(self, obs, bucket, prefix="index/", threads=16):
+        self.obs = obs
+        self.bucket = bucket
+        self.prefix = prefix
+        self.threads = threads
+
+    @staticmethod
+    def identity(url, meta):
+        """
+        :return: hex digest, None if the source has no validator to tell its version
+        """
+        validator = Downloader._validator(meta)
+        if not validator:
+            return None
+
+        return hashlib.sha1(("%s|%s|%s" % (url, meta["size"], validator)).encode("utf-8")).hexdigest()
+
+    def register(self, url, meta, key, checksums):
+        """
+        record source url with meta is downloaded to key
+        """
+        identity = self.identity(url, meta)
+        if identity is None:
+            return None
+
+        self.obs.put(self.bucket, self.prefix + identity, json.dumps({
+            "url": url,
+            "size": meta["size"],
+            "validator": Downloader._validator(meta),
+            "key": key,
+            "checksums": checksums,
+            "time": time.time()
+        }))
+
+        return identity
+
+    def lookup(self, sources, algorithms=("md5",)):
+        """
+        :param sources: list [(url, meta)] of mirrors of one file
+        :param algorithms: checksums the entry must have
+        :return: entry of the first mirror found whose object still exists with the same size, or None
+        """
+        for url, meta in sources:
+            identity = self.identity(url, meta)
+            if identity is None:
+                continue
+            content = self.obs.get(self.bucket, self.prefix + identity)
+            if content is None:
+                continue
+            entry = json.loads(content)
+            if not set(algorithms) <= set(entry.get("checksums", {})):
+                continue
+            stat = self.obs.stat(self.bucket, entry["key"])
+            if stat is not None and stat["size"] == meta["size"]:
+                return entry
+
+        return None
+
+    def lookup_many(self, sources, algorithms=("md5",)):
+        """
+        :param sources: list of sources for lookup
+        :return: list of entry or None
+        """
+        with ThreadPoolExecutor(max_workers=max(self.threads, 1)) as executor:
+            return list(executor.map(lambda i: self.lookup(i, algorithms), sources))
+
+
+class ObjectIndex(object):
+    """
+    objects under a prefix, updated incrementally between checks: a few
+    missing keys are checked with concurrent HEAD requests, many are
+    listed from the last known key before them
+    """
+
+    def __init__(self, obs, bucket, prefix, head_threshold=100, threads=16):
+        """
+
+        :param obs: OBS
+        :param bucket:
+        :param prefix:
+        :param head_threshold: 缺失对象数不超过该值时逐个 HEAD 检查, 否则分页列举
+        :param threads: HEAD 并发数
+        """
+        self.obs = obs
+        self.bucket = bucket
+        self.prefix = prefix
+        self.head_threshold = head_threshold
+        self.threads = threads
+        self.objects = {}
+
+    def refresh(self, keys):
+        """
+        look for keys not indexed yet
+        :param keys:
+        :return:
+        """
+        missing = sorted(set(k for k in keys if k not in self.objects))
+        if not missing:
+            return
+
+        if len(missing) <= self.head_threshold:
+            for key, stat in self.obs.stat_many(self.bucket, missing, self.threads).items():
+                if stat is not None:
+                    self.objects[key] = stat
+            return
+
+        known = [k for k in self.objects if k < missing[0]]
+        marker = max(known) if known else None
+        for key, stat in self.obs.iter_objects(self.bucket, self.prefix, marker):
+            self.objects[key] = stat
+            if key >= missing[-1]:
+                break
+
+    def exists(self, keys):
+        """
+
+        :param keys:
+        :return: list keys exist, in order of keys
+        """
+        self.refresh(keys)
+
+        return [k for k in keys if k in self.objects]
+
+
+class TaskQueue(object):
+    """
+    task queue in bucket
+    {prefix}pending/{name}: content is the task file, removed when the task is finished
+    {prefix}claimed/{name}: json {"worker": worker claimed it, "time": claim time}
+    {prefix}workers/{worker}: heartbeat of the worker
+    a task is claimed by creating the claimed object, only one worker can create it.
+    a claim of a worker without heartbeat is stale, it is removed so the
+    task is claimed again
+    """
+
+    def __init__(self, obs, bucket, prefix="queue/"):
+        self.obs = obs
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def submit(self, name, task):
+        self.obs.put(self.bucket, "%spending/%s" % (self.prefix, name), task)
+
+        return name
+
+    def _claim_of(self, name):
+        """
+        :return: dict {"worker", "time"} of the claim, None if not claimed
+        """
+        content = self.obs.get(self.bucket, "%sclaimed/%s" % (self.prefix, name))
+        if content is None:
+            return None
+        try:
+            return json.loads(content.decode("utf-8"))
+        except ValueError:
+            return {"worker": content.decode("utf-8"), "time": 0}
+
+    def _reap(self, name, alive, timeout):
+        """
+        remove the claim of name if its worker has no heartbeat in timeout seconds
+        :return: True if removed
+        """
+        claim = self._claim_of(name)
+        if claim is None or claim["worker"] in alive or time.time() - claim["time"] <= timeout:
+            return False
+        # read again just before removing, a new claim of a live worker is kept
+        if self._claim_of(name) != claim:
+            return False
+        LOG.warning("Claim of task %s by %s is stale, release it" % (name, claim["worker"]))
+        self.obs.delete(self.bucket, "%sclaimed/%s" % (self.prefix, name))
+
+        return True
+
+    def claim(self, worker, timeout=300):
+        """
+        :param worker: worker id
+        :param timeout: 秒, claims of workers without heartbeat for this long are released
+        :return: (name, task) or None
+        """
+        pending = "%spending/" % self.prefix
+        alive = None
+        for key, _ in self.obs.iter_objects(self.bucket, pending):
+            name = key[len(pending):]
+            content = json.dumps({"worker": worker, "time": time.time()})
+            if not self.obs.create(self.bucket, "%sclaimed/%s" % (self.prefix, name), content):
+                if alive is None:
+                    alive = self.workers(timeout)
+                if not self._reap(name, alive, timeout) or \
+                        not self.obs.create(self.bucket, "%sclaimed/%s" % (self.prefix, name), content):
+                    continue
+            task = self.obs.get(self.bucket, key)
+            if task is None:
+                self.obs.delete(self.bucket, "%sclaimed/%s" % (self.prefix, name))
+                continue
+            LOG.info("%s claimed task %s" % (worker, name))
+            return name, task.decode("utf-8")
+
+        return None
+
+    def finish(self, name, task=None):
+        """
+        :param task: task claimed, the pending object is kept if it is submitted again since
+        """
+        key = "%spending/%s" % (self.prefix, name)
+        content = self.obs.get(self.bucket, key)
+        if content is not None and (task is None or content.decode("utf-8") == task):
+            self.obs.delete(self.bucket, key)
+        self.obs.delete(self.bucket, "%sclaimed/%s" % (self.prefix, name))
+
+    def heartbeat(self, worker, state):
+        self.obs.put(self.bucket, "%sworkers/%s" % (self.prefix, worker), json.dumps({
+            "time": time.time(),
+            "state": state
+        }))
+
+    def leave(self, worker):
+        self.obs.delete(self.bucket, "%sworkers/%s" % (self.prefix, worker))
+
+    def workers(self, timeout=60):
+        """
+        workers with a heartbeat in timeout seconds
+        :param timeout:
+        :return: {worker: state}
+        """
+        r = {}
+        for key, _ in self.obs.iter_objects(self.bucket, "%sworkers/" % self.prefix):
+            content = self.obs.get(self.bucket, key)
+            if content is None:
+                continue
+            beat = json.loads(content.decode("utf-8"))
+            if time.time() - beat["time"] <= timeout:
+                r[key.split("/")[-1]] = beat["state"]
+
+        return r
+
+
+class Segment(object):
+    """
+    bytes [start, end) of a file being downloaded, start moves forward as
+    bytes are written, end is lowered when the rest is taken by another
+    connection
+    """
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.begin = start
+        self.begin_time = time.time()
+
+    @property
+    def remain(self):
+        return max(self.end - self.start, 0)
+
+    @property
+    def rate(self):
+        return (self.start - self.begin) / max(time.time() - self.begin_time, 1e-6)
+
+    def eta(self):
+        return self.remain / max(self.rate, 1.0)
+
+
+class Mirrors(object):
+    """
+    equivalent urls of one object with their If-Range validators, a mirror
+    is dropped after an error as long as another one is left
+    """
+
+    def __init__(self, urls, validators):
+        """
+
+        :param urls:
+        :param validators: dict {url: validator}
+        """
+        self.urls = list(urls)
+        self.validators = validators
+        self.bad = set()
+        self.stats = OrderedDict((u, [0, 0.0]) for u in self.urls)
+        self.lock = threading.Lock()
+
+    def pick(self, i=0):
+        """
+        :param i: connection index, connections are spread over healthy mirrors
+        :return: url
+        """
+        with self.lock:
+            healthy = [u for u in self.urls if u not in self.bad]
+            return healthy[i % len(healthy)]
+
+    def drop(self, url):
+        """
+        :return: True if url is dropped, False if it is the last one
+        """
+        with self.lock:
+            if url in self.bad:
+                return True
+            if len(self.urls) - len(self.bad) <= 1:
+                return False
+            self.bad.add(url)
+            LOG.warning("Drop mirror %r" % url)
+            return True
+
+    def add(self, url, size, seconds):
+
+        with self.lock:
+            self.stats[url][0] += size
+            self.stats[url][1] += seconds
+
+    def log(self):
+
+        if len(self.urls) < 2:
+            return
+        for url, (size, seconds) in self.stats.items():
+            LOG.info("Mirror %r delivered %s bytes at %.2f MB/s%s" % (
+                url, size, size / max(seconds, 1e-6) / 1024 / 1024, ", dropped" if url in self.bad else ""))
+
+
+class Downloader(object):
+
+    HEADER = {
+        'User-Agent': 'user-agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.132 Safari/537.36'
+    }
+    CHUNK_SIZE = 1024*1024
+    MIN_STEAL_SIZE = 4*1024*1024
+
+    def __init__(self, threads=1, min_segment_size=16*1024*1024, timeout=60, meta=None):
+        """
+
+        :param threads: 单个文件的并发连接数
+        :param min_segment_size: 分段下载时每段最小字节数
+        :param timeout: 连接/读取超时 秒
+        :param meta: dict {url: meta} probed already, see probe
+        """
+        self.threads = max(int(threads), 1)
+        self.min_segment_size = min_segment_size
+        self.timeout = timeout
+        self.meta = dict(meta or {})
+        self.metrics = None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=max(self.threads, 32))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @staticmethod
+    def _parse_meta(response, size):
+
+        return {
+            "size": size,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "accept_ranges": response.status_code == 206 or
+                             response.headers.get("Accept-Ranges", "").lower() == "bytes"
+        }
+
+    def _probe(self, url):
+
+        try:
+            response = self.session.head(url, headers=self.HEADER, allow_redirects=True, timeout=self.timeout)
+            if response.status_code == 200 and 'Content-Length' in response.headers:
+                return self._parse_meta(response, int(response.headers['Content-Length']))
+
+            header = dict(self.HEADER, Range="bytes=0-0")
+            response = self.session.get(url, headers=header, stream=True, timeout=self.timeout)
+            response.close()
+            if response.status_code == 206 and "/" in response.headers.get("Content-Range", ""):
+                size = response.headers["Content-Range"].split("/")[-1]
+                if size != "*":
+                    return self._parse_meta(response, int(size))
+            elif response.status_code == 200 and 'Content-Length' in response.headers:
+                return self._parse_meta(response, int(response.headers['Content-Length']))
+            LOG.error("Can not get length of %r, status %s." % (url, response.status_code))
+        except requests.RequestException as e:
+            LOG.error("Can not get length of %r: %s" % (url, e))
+
+        return None
+
+    @staticmethod
+    def mirrors(url):
+        """
+        :param url: an url or a list of mirrors of the same object
+        :return: list of urls
+        """
+        return list(url) if isinstance(url, (list, tuple)) else [url]
+
+    def probe(self, url):
+        """
+        get size, validators and range support of url by HEAD, fall back to a
+        range GET, results are cached in self.meta
+        :param url: an url or a list of mirrors of the same object, see _probe_mirrors
+        :return: dict {"size": int, "etag": str, "last_modified": str, "accept_ranges": bool} or None,
+                 with "mirrors": [url] for a list
+        """
+        if isinstance(url, (list, tuple)):
+            return self._probe_mirrors(url)
+
+        if url not in self.meta:
+            meta = self._probe(url)
+            if meta is None:
+                return None
+            self.meta[url] = meta
+
+        return self.meta[url]
+
+    def probe_all(self, urls, threads=16):
+        """
+        probe urls concurrently over the shared session
+        :param urls:
+        :param threads:
+        :return: OrderedDict {url: meta or None}
+        """
+        with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+            return OrderedDict(zip(urls, executor.map(self.probe, urls)))
+
+    def _probe_mirrors(self, urls):
+        """
+        mirrors differing from the first healthy one in size or strong etag,
+        or without range support when it has, are left out
+        :return: meta of the first healthy mirror with "mirrors": [url]
+        """
+        healthy = [(u, m) for u, m in self.probe_all(urls).items() if m]
+        if not healthy:
+            return None
+
+        url, first = healthy[0]
+        mirrors = [url]
+        for u, m in healthy[1:]:
+            if m["size"] != first["size"] or \
+                    (self._strong_etag(first) and self._strong_etag(m) and first["etag"] != m["etag"]):
+                LOG.warning("Mirror %r does not match %r, size %s, etag %s" % (u, url, m["size"], m.get("etag")))
+            elif first["accept_ranges"] and not m["accept_ranges"]:
+                LOG.warning("Mirror %r does not accept ranges" % u)
+            else:
+                mirrors.append(u)
+
+        return dict(first, mirrors=mirrors)
+
+    @staticmethod
+    def _strong_etag(meta):
+
+        etag = meta.get("etag")
+        return etag if etag and not etag.startswith("W/") else None
+
+    @classmethod
+    def _validator(cls, meta):
+        """
+        validator for If-Range, weak etag can not be used
+        """
+        return cls._strong_etag(meta) or meta.get("last_modified")
+
+    def _mirrors(self, url, meta):
+
+        urls = meta.get("mirrors", self.mirrors(url))
+        return Mirrors(urls, dict((u, self._validator(self.meta.get(u, meta))) for u in urls))
+
+    def _iter_range(self, url, start, end, validator=None):
+        """
+        iterate over bytes [start, end) of url
+        :param url:
+        :param start:
+        :param end:
+        :param validator: etag or last modified, send as If-Range
+        :return: generator of bytes
+        """
+        header = dict(self.HEADER, Range="bytes=%s-%s" % (start, end - 1))
+        if validator:
+            header["If-Range"] = validator
+        response = self.session.get(url, headers=header, stream=True, timeout=self.timeout)
+        try:
+            if response.status_code == 200 and start > 0:
+                raise SourceChanged("%s changed, full content returned for range %s-%s" % (url, start, end))
+            if response.status_code != 206 and not (start == 0 and response.status_code == 200):
+                raise IOError("Unexpected status %s for range %s-%s" % (response.status_code, start, end))
+
+            for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                if not chunk:
+                    continue
+                chunk = chunk[:end - start]
+                yield chunk
+                start += len(chunk)
+                if start >= end:
+                    break
+        finally:
+            response.close()
+
+    def _checkpoint(self, fh, journal, out, start, end):
+        """
+        flush bytes [start, end) of fh to disk then record them in journal
+        :return: end
+        """
+        fh.flush()
+        os.fsync(fh.fileno())
+        journal.add_range(out, start, end)
+
+        return end
+
+    def _download(self, url, start, end, out, validator=None, journal=None, callback=None, segment=None):
+        """
+        write bytes [start, end) of url to out at offset start
+        :param url:
+        :param start:
+        :param end:
+        :param out: file must exist
+        :param validator: etag or last modified of url
+        :param journal: Journal to record completed ranges of out
+        :param callback: function called with bytes count of each chunk written
+        :param segment: Segment, stop at its end when lowered and move its start
+        :return: offset reached, equals to end when success
+        """
+        LOG.info("Download %r from %s to %s" % (url, start, end))
+
+        mark = start
+        with open(out, "r+b") as fh:
+            fh.seek(start)
+            try:
+                for chunk in self._iter_range(url, start, end, validator):
+                    if segment is not None:
+                        chunk = chunk[:segment.end - start]
+                        if not chunk:
+                            break
+                    fh.write(chunk)
+                    start += len(chunk)
+                    if segment is not None:
+                        segment.start = start
+                    if callback is not None:
+                        callback(len(chunk))
+                    if journal is not None and start - mark >= self.min_segment_size:
+                        mark = self._checkpoint(fh, journal, out, mark, start)
+            except SourceChanged:
+                raise
+            except (requests.RequestException, IOError) as e:
+                LOG.warning("Download %r stopped at %s: %s" % (url, start, e))
+
+            if journal is not None:
+                self._checkpoint(fh, journal, out, mark, start)
+
+        return start
+
+    def _download_from(self, mirrors, i, start, end, out, journal=None, callback=None, segment=None):
+        """
+        download from the mirror of connection i, drop the mirror on error
+        :return: offset reached, mirror dropped
+        """
+        url = mirrors.pick(i)
+        begin = time.time()
+        try:
+            reached = self._download(url, start, end, out, mirrors.validators[url], journal, callback, segment)
+        except SourceChanged:
+            if not mirrors.drop(url):
+                raise
+            return start, True
+        mirrors.add(url, reached - start, time.time() - begin)
+        # end of a segment is lowered when its rest is stolen, reaching the new end is a success
+        limit = segment.end if segment is not None else end
+
+        return reached, reached < limit and mirrors.drop(url)
+
+    def _download_segment(self, mirrors, i, segment, out, retry, journal=None, callback=None):
+
+        n = 0
+        while True:
+            reached, dropped = self._download_from(mirrors, i, segment.start, segment.end, out, journal, callback,
+                                                   segment)
+            if segment.start >= segment.end:
+                return 0
+
+            if dropped:
+                continue
+
+            if n >= retry:
+                LOG.error("%s segment %s-%s download failed" % (mirrors.pick(i), segment.start, segment.end))
+                return 1
+
+            n += 1
+            self._retried(mirrors.pick(i))
+            time.sleep(min(2 ** n, 30))
+
+    def _retried(self, url):
+
+        if self.metrics is not None:
+            self.metrics.add("retries", 1, url)
+
+    def _split(self, file_size, done=()):
+        """
+        split bytes not done into at most threads ranges
+        :param file_size:
+        :param done: list [(start, end)] completed already
+        :return: list [(start, end)]
+        """
+        todo = []
+        pos = 0
+        for start, end in sorted(done):
+            if start > pos:
+                todo.append((pos, start))
+            pos = max(pos, end)
+        if pos < file_size:
+            todo.append((pos, file_size))
+
+        counts = [1] * len(todo)
+        while todo and sum(counts) < self.threads:
+            size, i = max(((todo[k][1] - todo[k][0]) / float(counts[k] + 1), k) for k in range(len(todo)))
+            if size < self.min_segment_size:
+                break
+            counts[i] += 1
+
+        r = []
+        for (start, end), n in zip(todo, counts):
+            step = (end - start) // n
+            for i in range(n):
+                r.append((start + i * step, end if i + 1 == n else start + (i + 1) * step))
+
+        return r
+
+    def _download_segments(self, mirrors, file_size, out, retry, journal=None, callback=None):
+
+        done = journal.get(out).get("ranges", []) if journal is not None else []
+        if not done:
+            with open(out, "wb") as fh:
+                fh.truncate(file_size)
+
+        url = mirrors.urls[0]
+        pending = [Segment(start, end) for start, end in self._split(file_size, done)]
+        LOG.info("Download %r to %s with %s segments from %s mirrors" % (url, out, len(pending), len(mirrors.urls)))
+        if not pending:
+            return 0
+
+        active = set()
+        lock = threading.Lock()
+
+        def take():
+            """
+            next pending segment, or the second half of the active segment
+            that would finish last
+            """
+            with lock:
+                if pending:
+                    segment = pending.pop(0)
+                    active.add(segment)
+                    return segment
+
+                victims = [v for v in active if v.remain >= 2 * self.MIN_STEAL_SIZE]
+                if not victims:
+                    return None
+                victim = max(victims, key=lambda v: v.eta())
+                split = victim.start + victim.remain // 2
+                segment = Segment(split, victim.end)
+                victim.end = split
+                active.add(segment)
+                LOG.info("Split %r %s-%s at %s" % (url, victim.start, segment.end, split))
+                return segment
+
+        def work(i):
+            code = 0
+            while True:
+                segment = take()
+                if segment is None:
+                    return code
+                code |= self._download_segment(mirrors, i, segment, out, retry, journal, callback)
+                with lock:
+                    active.discard(segment)
+
+        # a journal with many holes gives more segments than threads, workers take them in turn
+        workers = min(len(pending), self.threads)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            codes = list(executor.map(work, range(workers)))
+
+        mirrors.log()
+        if any(codes):
+            LOG.error("%s download failed" % url)
+            return 1
+
+        LOG.info("%s download success" % url)
+        return 0
+
+    def stream(self, url, retry=5):
+        """
+        iterate over the content of url without touching local disk,
+        resume from the current offset on error
+        :param url:
+        :param retry:
+        :return: generator of bytes
+        """
+        meta = self.probe(url)
+        if meta is None:
+            raise IOError("Can not get length of %r" % url)
+        file_size = meta["size"]
+        mirrors = self._mirrors(url, meta)
+        LOG.info("Stream %r, size %s" % (url, file_size))
+
+        start = 0
+        n = 0
+        while start < file_size:
+            source = mirrors.pick()
+            try:
+                for chunk in self._iter_range(source, start, file_size, mirrors.validators[source]):
+                    start += len(chunk)
+                    yield chunk
+            except SourceChanged:
+                if not mirrors.drop(source):
+                    raise
+                continue
+            except (requests.RequestException, IOError) as e:
+                LOG.warning("Stream %r stopped at %s: %s" % (source, start, e))
+
+            if start >= file_size:
+                break
+
+            if mirrors.drop(source):
+                continue
+
+            if n >= retry:
+                e = "%s stream failed at %s" % (url, start)
+                LOG.error(e)
+                raise IOError(e)
+
+            n += 1
+            self._retried(url)
+            time.sleep(min(2 ** n, 30))
+
+        LOG.info("%s stream success" % url)
+
+    def _resume(self, url, meta, out, journal):
+        """
+        drop the journal record and partial file of out if they do not match url
+        """
+        record = journal.get(out)
+        validator = self._validator(meta)
+        ranges = record.get("ranges", [])
+        if record.get("url") == url and record.get("size") == meta["size"] and \
+                record.get("validator") == validator and os.path.exists(out) and \
+                os.path.getsize(out) >= max([e for s, e in ranges] or [0]):
+            LOG.info("Resume %r to %s, ranges done: %s" % (url, out, ranges))
+            return
+
+        if os.path.exists(out):
+            os.remove(out)
+        journal.reset(out, url=url, size=meta["size"], validator=validator)
+
+    def _download_file(self, url, meta, out, retry, journal=None, callback=None):
+
+        file_size = meta["size"]
+        mirrors = self._mirrors(url, meta)
+        if journal is not None:
+            self._resume(url, meta, out, journal)
+
+        if self.threads > 1 and meta["accept_ranges"] and file_size >= 2 * self.min_segment_size:
+            return self._download_segments(mirrors, file_size, out, retry, journal, callback)
+
+        LOG.info("Download %r to %s" % (url, out))
+        if not os.path.exists(out):
+            open(out, "wb").close()
+
+        if journal is not None:
+            ranges = journal.get(out).get("ranges", [])
+            with open(out, "r+b") as fh:
+                fh.truncate(ranges[0][1] if ranges and ranges[0][0] == 0 else 0)
+
+        n = 0
+        while True:
+            download_size = os.path.getsize(out)
+
+            if download_size >= file_size:
+                mirrors.log()
+                LOG.info("%s download success" % url)
+                return 0
+
+            if n >= retry:
+                LOG.error("%s download failed" % url)
+                return 1
+
+            if n:
+                self._retried(mirrors.pick())
+            reached, dropped = self._download_from(mirrors, 0, download_size, file_size, out, journal, callback)
+            if not dropped:
+                n += 1
+
+    def download(self, url, out, retry=5, journal=None, callback=None):
+        """
+        download url to out, in byte ranges on several connections if possible
+        :param url: an url or a list of mirrors of the same object, ranges are
+                    fetched from all mirrors and a mirror is dropped on error
+        :param out:
+        :param retry: 每个分段的重试次数
+        :param journal: Journal, resume from the completed ranges recorded for out
+        :param callback: function called with bytes count of each chunk written
+        :return: 0 success, 1 failed
+        """
+        if isinstance(url, tuple):
+            url = list(url)
+        for n in range(retry + 1):
+            meta = self.probe(url)
+            if meta is None:
+                break
+
+            try:
+                return self._download_file(url, meta, out, retry, journal, callback)
+            except SourceChanged as e:
+                LOG.warning("%s, restart download" % e)
+                for u in self.mirrors(url):
+                    self.meta.pop(u, None)
+                if journal is not None:
+                    journal.remove(out)
+                if os.path.exists(out):
+                    os.remove(out)
+
+        LOG.error("%s download failed" % url)
+        return 1
+
+
+class Hwget(object):
+
+    def __init__(self, ak, sk, region, project_id, bucket, image="dbe9b51f-b64e-4373-a9d5-446885156ebf",
+                 cache_file=None, cache_ttl=3600, wheels=None):
+        """
+        :param wheels: prefix in bucket of wheels put by stage, servers install from it instead of GitHub
+        """
 
         self.ak = ak
         self.sk = sk
@@ -454,20 +2254,14 @@ class Hwget(object):
         self.image = image
 
         self.cloud = Cloud(
-            ak=ak, sk=sk, region=region, project_id=project_id
+            ak=ak, sk=sk, region=region, project_id=project_id, cache_file=cache_file, cache_ttl=cache_ttl
         )
 
         self.obs = OBS(
             ak=ak, sk=sk, region=region
         )
-
-    @staticmethod
-    def _get_content_size(url):
-        resp = requests.get(url, stream=True)
-        if resp.status_code == 200 and 'Content-Length' in resp.headers:
-            return int(resp.headers['Content-Length'])
-        else:
-            return 0
+        self.indexes = {}
+        self.wheels = wheels
 
     @staticmethod
     def _get_disk_size_gb(size):
@@ -480,7 +2274,7 @@ class Hwget(object):
 
     @staticmethod
     def _generate_id(urls):
-        text = "|".join(sorted(urls))
+        text = "|".join(sorted(",".join(Downloader.mirrors(u)) for u in urls))
 
         import hashlib
         return hashlib.md5(text.encode("utf-8")).hexdigest()
@@ -489,113 +2283,640 @@ class Hwget(object):
         if folder[-1] != "/":
             folder += "/"
 
-        r = []
-        files_exists = self.obs.ls(bucket, folder)
+        key = (bucket, folder)
+        if key not in self.indexes:
+            self.indexes[key] = ObjectIndex(self.obs, bucket, folder)
+
+        exists = set(f[len(folder):] for f in self.indexes[key].exists([folder + f for f in files]))
+        if len(exists) < len(files):
+            exists.update(self.packed_files(bucket, folder[:-1]))
+
+        return [f for f in files if f in exists]
 
-        for f in files:
-            if folder+f in files_exists:
-                r.append(f)
+    def packed_files(self, bucket, folder):
+        """
+        files packed into tar shards, from the index next to each shard
+        :param bucket:
+        :param folder: date/uid
+        :return: dict {out: (shard key, offset, size)}
+        """
+        r = {}
+        for key, _ in self.obs.iter_objects(bucket, folder + "/packs/"):
+            if not key.endswith(".tar.idx"):
+                continue
+            for line in self.obs.get(bucket, key).decode("utf-8").splitlines():
+                out, offset, size = line.split("\t")
+                r[out] = (key[:-len(".idx")], int(offset), int(size))
 
         return r
 
-    def get(self, urls, outs=None, bucket=None, flavors=("s3.small.1", "s3.medium.2")):
+    def read_file(self, bucket, folder, out, packed=None):
+        """
+        read a downloaded file into memory, a packed file by a range GET of its shard
+        :param bucket:
+        :param folder: date/uid
+        :param out:
+        :param packed: result of packed_files, read from bucket by default
+        :return: bytes or None if not exists
+        """
+        content = self.obs.get(bucket, "%s/%s" % (folder, out))
+        if content is not None:
+            return content
 
-        if bucket is None:
-            bucket = self.bucket
-        if outs is None:
-            outs = [u.split("/")[-1] for u in urls]
+        if packed is None:
+            packed = self.packed_files(bucket, folder)
+        if out not in packed:
+            return None
+        key, offset, size = packed[out]
 
-        size_all = 0
-        LOG.info("Get %s URLs." % len(urls))
-        for url in urls:
-            size = self._get_content_size(url)
-            if size == 0:
-                e = "Can not get length of %r." % url
-                LOG.error(e)
-                raise Exception(e)
-            else:
-                LOG.info("URL {:} length {:,}".format(url, size))
-                size_all += size
-
-        LOG.info("Download size: {:,}".format(size_all))
-        disk_gb = self._get_disk_size_gb(size_all)
-        uid = self._generate_id(urls)
-        date = datetime.utcnow().strftime('%Y%m%d')
-        folder = date + "/" + uid
-        self.obs.mkdir(bucket, date+"/")
-        self.obs.mkdir(bucket, folder + "/")
-
-        files_exists = self._check_files_exists_in_obs(bucket, folder, outs)
-        if len(files_exists) == len(outs):
-            LOG.info("Download already.")
-            return 0
+        return self.obs.get(bucket, key, offset, offset + size - 1) if size else b""
+
+    @staticmethod
+    def _shard(items, sizes, n):
+        """
+        bin-pack items into at most n shards of near equal total size, largest first
+        :param items:
+        :param sizes:
+        :param n:
+        :return: list [(total size, [item])] of non-empty shards
+        """
+        shards = [[0, i, []] for i in range(max(n, 1))]
+        for item, size in sorted(zip(items, sizes), key=lambda d: d[1], reverse=True):
+            shard = min(shards, key=lambda d: (d[0], d[1]))
+            shard[0] += size
+            shard[2].append(item)
+
+        return [(total, items) for total, i, items in shards if items]
 
+    def _put_task(self, bucket, folder, name, pairs, meta, methods=None):
+        """
+        put task file of a shard
+        :param methods: dict {out: compression method}
+        :return: task file
+        """
         task_dict = {
-            uid: {
-                "urls": urls,
-                "outs": outs
+            name: {
+                "urls": [u for u, o in pairs],
+                "outs": [o for u, o in pairs],
+                "meta": {m: meta[m] for u, o in pairs for m in Downloader.mirrors(u) if m in meta}
             }
         }
+        methods = {o: methods[o] for u, o in pairs if o in (methods or {})}
+        if methods:
+            task_dict[name]["compress"] = methods
 
-        task_file = "%s/%s/%s.cfg" % (date, uid, uid)
+        task_file = "%s/%s.cfg" % (folder, name)
         self.obs.put(bucket, task_file, json.dumps(task_dict))
 
-        cfg = {
-            "ak": self.ak,
-            "sk": self.sk,
-            "region": self.region,
-            "bucket": self.bucket,
-            "tasks": [task_file]
-            }
+        return task_file
+
+    def stage(self, source=None, prefix=None, platform="manylinux2014_x86_64", python_version=None, pip_args=()):
+        """
+        put wheels of hwget and its requirements for the image to bucket,
+        servers install them offline with signed urls. only the wheel of
+        hwget is built, requirements resolved by the python running this
+        are downloaded as binary wheels of platform and python_version.
+        those released as source only are built into wheels here if pure
+        python, else put as source to be built on the server
+        :param source: pip requirement to build, default: this source tree or the GitHub archive
+        :param prefix: default: hwget/{version}/
+        :param platform: wheel platform of the image
+        :param python_version: python of the image like 3.8, default: python running this
+        :param pip_args: extra args of pip download, such as --index-url
+        :return: prefix
+        """
+        if source is None:
+            root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            if os.path.isfile(os.path.join(root, "setup.py")):
+                source = root
+            else:
+                source = "https://github.com/FlyPythons/hwget/archive/master.zip"
+        if prefix is None:
+            prefix = "hwget/%s/" % __version__
+        if python_version is None:
+            python_version = "%s.%s" % sys.version_info[:2]
+        pip = [sys.executable, "-m", "pip"]
+        target = ["--only-binary=:all:", "--platform", platform, "--python-version", python_version,
+                  "--implementation", "cp", "--no-deps"]
+
+        work_dir = tempfile.mkdtemp(prefix="hwget_wheels_")
+        build_dir, source_dir, wheel_dir = [os.path.join(work_dir, d) for d in ("build", "source", "wheels")]
+        try:
+            LOG.info("Build wheel of %s" % source)
+            subprocess.check_call(pip + ["wheel", "-q", "--no-deps", "--wheel-dir", build_dir, source])
+            hwget_wheel = os.listdir(build_dir)[0]
+            os.makedirs(wheel_dir)
+            shutil.copy(os.path.join(build_dir, hwget_wheel), wheel_dir)
+
+            # pip can not resolve requirements for another platform when some of them are source only,
+            # so they are resolved here and each one is downloaded again for the image
+            subprocess.check_call(pip + ["download", "-q", "--dest", source_dir,
+                                         os.path.join(build_dir, hwget_wheel)] + list(pip_args))
+            binary, sdists = [], []
+            for name in sorted(os.listdir(source_dir)):
+                if name == hwget_wheel:
+                    continue
+                elif name.endswith(".whl"):
+                    binary.append("%s==%s" % tuple(name.split("-")[:2]))
+                else:
+                    sdists.append(name)
+
+            LOG.info("Download %s wheels for %s python %s" % (len(binary), platform, python_version))
+            subprocess.check_call(pip + ["download", "-q", "--dest", wheel_dir] + target + binary + list(pip_args))
+            for name in sdists:
+                path = os.path.join(source_dir, name)
+                subprocess.check_call(pip + ["wheel", "-q", "--no-deps", "--wheel-dir", build_dir, path])
+                built = [f for f in os.listdir(build_dir) if f != hwget_wheel]
+                if len(built) == 1 and built[0].endswith("-none-any.whl"):
+                    shutil.move(os.path.join(build_dir, built[0]), wheel_dir)
+                else:
+                    LOG.warning("%s is not pure python, it is built on the server" % name)
+                    shutil.copy(path, wheel_dir)
+                for f in built:
+                    if os.path.exists(os.path.join(build_dir, f)):
+                        os.remove(os.path.join(build_dir, f))
+            if any(not f.endswith(".whl") for f in os.listdir(wheel_dir)):
+                subprocess.check_call(pip + ["download", "-q", "--dest", wheel_dir] + target +
+                                      ["setuptools", "wheel"] + list(pip_args))
+
+            wheels = sorted(os.listdir(wheel_dir))
+            for name in wheels:
+                LOG.info("Put %s%s" % (prefix, name))
+                self.obs.upload(self.bucket, prefix + name, os.path.join(wheel_dir, name))
+        finally:
+            shutil.rmtree(work_dir)
+
+        self.obs.put(self.bucket, prefix + "wheels.json", json.dumps({
+            "version": __version__,
+            "source": source,
+            "platform": platform,
+            "python_version": python_version,
+            "wheels": wheels
+        }))
+        self.wheels = prefix
+
+        return prefix
+
+    def _install_script(self, expires=3600):
+        """
+        fetch the staged files at the same time, the GitHub archive is
+        installed instead if any of them fails
+        """
+        if not self.wheels:
+            return "pip install https://github.com/FlyPythons/hwget/archive/master.zip"
+
+        content = self.obs.get(self.bucket, self.wheels + "wheels.json")
+        if content is None:
+            e = "Wheels %r not found in bucket %s, run stage first." % (self.wheels, self.bucket)
+            LOG.error(e)
+            raise Exception(e)
+
+        r = ["mkdir -p /tmp/wheels", "pids=\"\""]
+        for name in json.loads(content)["wheels"]:
+            r.append("curl -sfL --retry 3 -o /tmp/wheels/%s '%s' & pids=\"$pids $!\"" % (
+                name, self.obs.sign(self.bucket, self.wheels + name, expires)))
+        r.append("fetched=1")
+        r.append("for pid in $pids; do wait $pid || fetched=0; done")
+        r.append("if [ $fetched = 1 ] && pip install --no-index --find-links /tmp/wheels hwget; then :; else")
+        r.append("    echo \"install staged wheels failed, install from GitHub\" >&2")
+        r.append("    pip install https://github.com/FlyPythons/hwget/archive/master.zip")
+        r.append("fi")
+
+        return "\n".join(r)
+
+    def _user_data(self, daemon=False):
+        """
+        boot script, phase timings are written to /etc/hwget_boot.json
+        """
+        return "\n".join([
+            "#! /bin/bash",
+            "t0=$(date +%s.%N)",
+            "up=$(cut -d' ' -f1 /proc/uptime)",
+            self._install_script(),
+            "t1=$(date +%s.%N)",
+            "echo \"{\\\"uptime\\\": $up, \\\"start\\\": $t0, \\\"installed\\\": $t1}\" > /etc/hwget_boot.json",
+            "python -m hwget.server %s/etc/download.cfg" % ("--daemon " if daemon else ""),
+            "shutdown -h now"
+        ])
+
+    def _select_flavor(self, flavors):
 
-        zone = None
-        flavor = None
         for f in flavors:
             zone = self.cloud.get_zone_has_flavor(f)
             if zone:
-                flavor = f
-                break
+                return f, zone
 
-        if zone is None:
-            e = "Flavors %s not found in region %s" % (flavors, self.region)
-            LOG.error(e)
-            raise Exception(e)
+        e = "Flavors %s not found in region %s" % (flavors, self.region)
+        LOG.error(e)
+        raise Exception(e)
+
+    def _launch(self, bucket, folder, name, pairs, meta, disk_gb, flavor, zone, cfg, metrics=None, methods=None):
+        """
+        put task file of a shard and create a server for it
+        :param metrics: Metrics to record provisioning time of the shard
+        :return: server id
+        """
+        task_file = self._put_task(bucket, folder, name, pairs, meta, methods)
+        cfg = dict(cfg, tasks=[task_file])
+
+        with (metrics or Metrics()).timer("provisioning", name):
+            return self.cloud.create_service(
+                name="download_%s" % name,
+                flavor=flavor,
+                root_gb=disk_gb,
+                image=self.image,
+                zone=zone,
+                personality={
+                    "path": "/etc/download.cfg",
+                    "content": json.dumps(cfg)
+                },
+                user_data=self._user_data()
+            )
+
+    def _worker_cfg(self, bucket, download_threads, upload_threads, stream, checksums, files, dedup=True,
+                    pack_size=0):
+
+        return {
+            "ak": self.ak,
+            "sk": self.sk,
+            "region": self.region,
+            "bucket": bucket,
+            "download_threads": download_threads,
+            "upload_threads": upload_threads,
+            "stream": stream,
+            "checksums": list(checksums),
+            "files": files,
+            "dedup": dedup,
+            "pack_size": pack_size
+            }
 
-        server = self.cloud.create_service(
-            name="download_%s" % uid,
+    def start_worker(self, bucket=None, flavors=("s3.small.1", "s3.medium.2"), disk_gb=100, idle_timeout=600,
+                     poll_interval=10, download_threads=4, upload_threads=4, stream=False, checksums=("md5",),
+                     files=4, dedup=True, pack_size=0):
+        """
+        create a long lived server which runs tasks submitted to the queue in bucket
+        :param bucket:
+        :param flavors: 按顺序选择可用实例类型
+        :param disk_gb: 磁盘大小, 需要容纳同时下载的文件
+        :param idle_timeout: 空闲多少秒后关机
+        :param poll_interval: 轮询队列间隔 秒
+        :return: server id
+        """
+        if bucket is None:
+            bucket = self.bucket
+
+        flavor, zone = self._select_flavor(flavors)
+        worker = "worker_%s" % datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        cfg = self._worker_cfg(bucket, download_threads, upload_threads, stream, checksums, files, dedup, pack_size)
+        cfg.update({
+            "worker": worker,
+            "idle_timeout": idle_timeout,
+            "poll_interval": poll_interval
+        })
+
+        return self.cloud.create_service(
+            name=worker,
             flavor=flavor,
             root_gb=disk_gb,
             image=self.image,
+            zone=zone,
             personality={
                 "path": "/etc/download.cfg",
                 "content": json.dumps(cfg)
             },
-            user_data="#! /bin/bash\npip install https://github.com/FlyPythons/hwget/archive/master.zip\npython -m hwget.server /etc/download.cfg\nshutdown -h now"
+            user_data=self._user_data(daemon=True)
         )
 
-        # wait for server shutdown
+    def workers(self, bucket=None, timeout=60):
+        """
+        workers alive
+        :return: {worker: idle or busy}
+        """
+        return TaskQueue(self.obs, bucket or self.bucket).workers(timeout)
+
+    def get(self, urls, outs=None, bucket=None, flavors=("s3.small.1", "s3.medium.2"), download_threads=4,
+            upload_threads=4, stream=False, checksums=("md5",), files=4, workers=1, use_worker=False, dedup=True,
+            pack_size=0, compress=None, meta=None, folder=None, launched=None):
+        """
+
+        :param urls: 每项为一个 url 或同一文件的多个镜像 url 列表
+        :param outs: 输出文件名, 默认为 url 文件名
+        :param bucket:
+        :param flavors: 按顺序选择可用实例类型
+        :param download_threads: 单个文件下载连接数
+        :param upload_threads: 单个文件同时上传的分段数
+        :param stream: 不落盘直接上传
+        :param checksums: md5 之外的校验值
+        :param files: 每台服务器同时处理的文件数
+        :param workers: 服务器数量, 按文件大小将 urls 均分到各服务器
+        :param use_worker: 有存活的 worker 时提交到队列, 不创建服务器, 下载参数以 worker 启动时为准
+        :param dedup: 之前下载过的相同文件在 OBS 内复制, 不再下载
+        :param pack_size: 不超过该字节数的文件打包到 {folder}/packs/ 下的 tar 中, 0 不打包, 见 read_file
+        :param compress: 上传前压缩, bgzf 或 zstd, 输出名加 .gz 或 .zst, 已压缩的文件不处理
+        :param meta: dict {url: meta} probed already, see Downloader.probe, other urls are probed
+        :param folder: OBS 目录 date/uid, 默认为当天日期和 urls 生成的 uid
+        :param launched: function called with ({server id: task name}, [task names queued]) before waiting,
+                         to record them so an interrupted get is resumed, see resume
+        :return: list files failed, empty if all files are in bucket
+        """
+        if bucket is None:
+            bucket = self.bucket
+        if outs is None:
+            outs = [Downloader.mirrors(u)[0].split("/")[-1] for u in urls]
+        methods = {}
+        if compress:
+            names = [output_name(o, compress) for o in outs]
+            methods = dict((n, compress) for o, n in zip(outs, names) if n != o)
+            outs = names
+
+        size_all = 0
+        metrics = Metrics()
+        LOG.info("Get %s URLs." % len(urls))
+        warm = threading.Thread(target=self.cloud.warm)
+        warm.start()
+        try:
+            downloader = Downloader(meta=meta)
+            with metrics.timer("probe"):
+                downloader.probe_all([m for u in urls for m in Downloader.mirrors(u) if m not in downloader.meta])
+            sources = []
+            sizes = {}
+            for url, out in zip(urls, outs):
+                m = downloader.probe(url)
+                if not m:
+                    e = "Can not get length of %r." % url
+                    LOG.error(e)
+                    raise Exception(e)
+                else:
+                    LOG.info("URL {:} length {:,}".format(url, m["size"]))
+                    size_all += m["size"]
+                    sources.append(m.get("mirrors", url))
+                    sizes[out] = m["size"]
+            meta = downloader.meta
+
+            LOG.info("Download size: {:,}".format(size_all))
+            if folder is None:
+                folder = datetime.utcnow().strftime('%Y%m%d') + "/" + self._generate_id(urls)
+            date, uid = folder.split("/")
+            self.obs.mkdir(bucket, date+"/")
+            self.obs.mkdir(bucket, folder + "/")
 
-        curr_success = []
-        while True:
-            res = self.cloud.show_server(server)
-            LOG.info("server %s is %s" % (server, res.status))
             files_exists = self._check_files_exists_in_obs(bucket, folder, outs)
-            new_success = set(files_exists) - set(curr_success)
-            if new_success:
-                for n in new_success:
-                    LOG.info("File %r downloaded." % n)
-
-            curr_success = files_exists
-            if res.status == "SHUTOFF":
-                LOG.info("Delete server %s" % server)
-                self.cloud.delete_server(server)
-                failed = set(outs) - set(curr_success)
+            if len(files_exists) == len(outs):
+                LOG.info("Download already.")
+                return []
+
+            pending = [(u, o) for u, o in zip(sources, outs) if o not in files_exists]
+            if dedup:
+                # compressed outputs are not copies of their sources
+                with metrics.timer("copy"):
+                    pending = self._copy_downloaded(bucket, folder, uid, [p for p in pending if p[1] not in methods],
+                                                    meta, checksums) + [p for p in pending if p[1] in methods]
+                if not pending:
+                    LOG.info("All files copied from former downloads.")
+                    return []
+
+            shards = self._shard(pending, [sizes[o] for u, o in pending], workers)
+            LOG.info("Split %s URLs into %s shards." % (len(pending), len(shards)))
+
+            names = [uid if len(shards) == 1 else "%s.%s" % (uid, i) for i in range(len(shards))]
+            if use_worker and self.workers(bucket):
+                tasks = TaskQueue(self.obs, bucket)
+                for name, (size, pairs) in zip(names, shards):
+                    tasks.submit(name, self._put_task(bucket, folder, name, pairs, meta, methods))
+                LOG.info("Submit %s tasks to the queue." % len(names))
+                if launched is not None:
+                    launched({}, names)
+                return self.wait({}, bucket, folder, outs, queued=names, metrics=metrics)
+
+            cfg = self._worker_cfg(bucket, download_threads, upload_threads, stream, checksums, files, dedup, pack_size)
+
+            warm.join()
+            flavor, zone = self._select_flavor(flavors)
+
+            futures = OrderedDict()
+            with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+                for name, (size, pairs) in zip(names, shards):
+                    disk_gb = self._get_disk_size_gb(0 if stream else size)
+                    futures[name] = executor.submit(
+                        self._launch, bucket, folder, name, pairs, meta, disk_gb, flavor, zone, cfg, metrics, methods)
+
+            servers = OrderedDict()
+            for name, future in futures.items():
+                try:
+                    servers[future.result()] = name
+                except Exception as e:
+                    LOG.error("Create server for %s failed: %s" % (name, e))
+
+            if not servers:
+                e = "No server created for %s" % folder
+                LOG.error(e)
+                raise Exception(e)
+
+            if launched is not None:
+                launched(servers, [])
+            # wait for server shutdown
+            return self.wait(servers, bucket, folder, outs, metrics=metrics)
+        finally:
+            # the warm up thread is joined on every path
+            warm.join()
+
+    def resume(self, servers, bucket, folder, outs, queued=()):
+        """
+        wait again on the servers and queued tasks of a get interrupted,
+        servers deleted and tasks finished already are left out
+        :param servers: dict {server id: task name}
+        :param queued: task names submitted to the queue
+        :return: list files failed, None if nothing is left to wait on
+        """
+        alive = OrderedDict()
+        for server, name in servers.items():
+            try:
+                self.cloud.show_server(server)
+            except Exception as e:
+                LOG.info("Server %s of %s is gone. %s" % (server, name, e))
+                continue
+            alive[server] = name
+
+        waiting = []
+        for name in queued:
+            progress = self._read_progress(bucket, folder, name)
+            if progress is None or progress["state"] == "running":
+                waiting.append(name)
+
+        if not alive and not waiting:
+            return None
+
+        LOG.info("Resume waiting on %s servers and %s queued tasks of %s" % (len(alive), len(waiting), folder))
+        return self.wait(alive, bucket, folder, outs, queued=waiting)
+
+    def _copy_downloaded(self, bucket, folder, uid, pending, meta, checksums):
+        """
+        copy files downloaded before by other tasks, their checksums are
+        written to {uid}.copy.{algorithm} manifests
+        :param pending: list [(url, out)]
+        :param meta: dict {url: meta} of each mirror
+        :return: list [(url, out)] not copied
+        """
+        algorithms = ["md5"] + [i for i in checksums if i != "md5"]
+        index = DedupIndex(self.obs, bucket)
+        entries = index.lookup_many(
+            [[(m, meta[m]) for m in Downloader.mirrors(u) if m in meta] for u, o in pending], algorithms)
+
+        def copy(item):
+            (url, out), entry = item
+            try:
+                self.obs.copy(bucket, entry["key"], bucket, "%s/%s" % (folder, out), entry["size"])
+            except Exception as e:
+                LOG.warning("Copy %r failed, download it. %s" % (entry["key"], e))
+                return False
+            return True
+
+        hits = [(p, e) for p, e in zip(pending, entries) if e is not None]
+        with ThreadPoolExecutor(max_workers=max(min(len(hits), 16), 1)) as executor:
+            copied = [(p, e) for (p, e), ok in zip(hits, executor.map(copy, hits)) if ok]
+        if not copied:
+            return pending
+
+        LOG.info("Copy %s files downloaded before." % len(copied))
+        for name in algorithms:
+            target = "%s/%s.copy.%s" % (folder, uid, name)
+            content = self.obs.get(bucket, target)
+            lines = OrderedDict()
+            for line in (content or b"").decode("utf-8").splitlines():
+                value, out = line.split("\t", 1)
+                lines[out] = value
+            for (url, out), entry in copied:
+                lines[out] = entry["checksums"][name]
+            self.obs.put(bucket, target, "".join("%s\t%s\n" % (v, o) for o, v in lines.items()))
+
+        done = set(o for (u, o), e in copied)
+        return [(u, o) for u, o in pending if o not in done]
+
+    def _read_progress(self, bucket, folder, name):
+
+        try:
+            content = self.obs.get(bucket, "%s/%s.progress" % (folder, name))
+        except Exception:
+            return None
+
+        return json.loads(content) if content else None
+
+    @staticmethod
+    def _log_progress(name, progress):
+
+        files = progress["files"].values()
+        total = sum(v["size"] for v in files) * 2
+        done = sum(min(v["downloaded"], v["size"]) + min(v["uploaded"], v["size"]) for v in files)
+        rate = sum(v["rate"] for v in files)
+        finished = len([v for v in files if v["state"] == "done"])
+        eta = "%ds" % ((total - done) / rate) if rate > 0 else "-"
+        LOG.info("%s progress %.1f%%, %s/%s files done, %.2f MB/s, ETA %s" % (
+            name, 100.0 * done / total if total else 100.0, finished, len(files), rate / 1024 / 1024, eta))
+
+    def _put_metrics(self, bucket, folder, name, metrics):
+        """
+        add phases of the client to the metrics document of a task
+        """
+        target = "%s/%s.metrics.json" % (folder, name)
+        try:
+            content = self.obs.get(bucket, target)
+        except Exception:
+            content = None
+        doc = json.loads(content) if content else {"task": name, "state": "unknown"}
+
+        client = metrics.to_dict()
+        doc["client"] = OrderedDict(client["phases"])
+        doc["client"].update(client["files"].get(name, {}))
+        self.obs.put(bucket, target, json.dumps(doc, indent=2))
+
+    def wait(self, servers, bucket, folder, outs, min_interval=10, max_interval=120, queued=(), metrics=None,
+             queue_timeout=3600):
+        """
+        poll the progress objects published by the servers with adaptive
+        backoff, delete each server after it is shutoff
+        :param servers: dict {server id: task name}
+        :param queued: task names submitted to the queue, done when its progress is not running
+        :param queue_timeout: 秒, a queued task without new progress for this long since submit or
+                              its last progress is given up, like one whose worker died
+        :param metrics: Metrics of the client, written into the metrics document of each task
+        :param bucket:
+        :param folder: date/uid
+        :param outs:
+        :param min_interval: 最短轮询间隔 秒
+        :param max_interval: 最长轮询间隔 秒
+        :return: list files failed
+        """
+        if metrics is None:
+            metrics = Metrics()
+        names = list(servers.values()) + list(queued)
+        start = time.time()
+        interval = min_interval
+        active = OrderedDict(servers)
+        queued = list(queued)
+        # progress of a queued task older than submit is from a former run
+        last_time = {name: time.time() for name in queued}
+        last_read = dict(last_time)
+        # bytes and states last seen of each task, progress is republished every interval even without change
+        last_seen = {}
+        curr_success = set()
+
+        def poll(name):
+            """
+            :return: (progress or None if not newer, True if bytes or states changed)
+            """
+            progress = self._read_progress(bucket, folder, name)
+            if progress is None or progress["time"] <= last_time.get(name, 0):
+                return None, False
+            last_time[name] = progress["time"]
+            self._log_progress(name, progress)
+            success = set(k[len(folder) + 1:] for k, v in progress["files"].items() if v["state"] == "done")
+            for n in success - curr_success:
+                LOG.info("File %r downloaded." % n)
+            curr_success.update(success)
+            seen = (progress["state"], sorted((k, v["downloaded"], v["uploaded"], v["state"])
+                                              for k, v in progress["files"].items()))
+            changed = seen != last_seen.get(name)
+            last_seen[name] = seen
+            return progress, changed
+
+        while True:
+            changed = False
+            for server, name in list(active.items()):
+                res = self.cloud.show_server(server)
+                LOG.info("server %s is %s" % (server, res.status))
+                progress, c = poll(name)
+                changed = changed or c
+
+                if res.status == "SHUTOFF":
+                    LOG.info("Delete server %s" % server)
+                    with metrics.timer("teardown", name):
+                        self.cloud.delete_server(server)
+                    del active[server]
+
+            for name in list(queued):
+                progress, c = poll(name)
+                changed = changed or c
+                if progress is not None:
+                    last_read[name] = time.time()
+                    if progress["state"] != "running":
+                        queued.remove(name)
+                elif time.time() - last_read[name] > queue_timeout:
+                    LOG.warning("No progress of task %s for %ss, give up" % (name, queue_timeout))
+                    queued.remove(name)
+
+            if not active and not queued:
+                metrics.add("wait", time.time() - start)
+                for name in names:
+                    self._put_metrics(bucket, folder, name, metrics)
+
+                failed = set(outs) - set(self._check_files_exists_in_obs(bucket, folder, outs))
                 if failed:
                     LOG.info("File %r failed." % failed)
                 else:
                     LOG.info("All files downloaded.")
 
                 LOG.info("You can check your files in bucket %s %r" % (bucket, folder))
-                break
+                return sorted(failed)
 
-            time.sleep(60)
+            interval = max(interval // 2, min_interval) if changed else min(interval * 2, max_interval)
+            time.sleep(interval)
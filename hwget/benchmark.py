@@ -0,0 +1,754 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+benchmarks against a local origin and OBS endpoint, the servers run in a
+child process so Usage only counts the process measured. they are forked
+on POSIX, where fork is not available they are spawned and scripts calling
+bench_* need an if __name__ == "__main__" guard
+"""
+import os
+import re
+import time
+import uuid
+import random
+import shutil
+import base64
+import hashlib
+import binascii
+import logging
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from xml.sax.saxutils import escape
+from xml.etree import ElementTree
+from email.utils import formatdate
+from collections import OrderedDict
+
+try:
+    from urllib.parse import urlparse, parse_qs, unquote
+except ImportError:
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from hwget.base import OBS, Downloader, Checksum
+from hwget.server import create_scheduler
+
+
+LOG = logging.getLogger(__name__)
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    serve files under server.root, support single Range request
+    server.latency: seconds before each response
+    server.rate: bytes per second of each response, 0 for no limit
+    server.slow: probability of a response to be limited by rate
+    server.fault: probability to close the connection in the middle of a body
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        LOG.debug(format % args)
+
+    def _open(self):
+        path = os.path.join(self.server.root, self.path.lstrip("/").split("?")[0])
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None, 0
+
+        stat = os.stat(path)
+        self.etag = '"%x-%x"' % (int(stat.st_mtime * 1000000), stat.st_size)
+        self.last_modified = self.date_time_string(stat.st_mtime)
+        return open(path, "rb"), stat.st_size
+
+    def _send_validators(self):
+        self.send_header("ETag", self.etag)
+        self.send_header("Last-Modified", self.last_modified)
+
+    def _range(self, size):
+        m = re.match(r"bytes=(\d*)-(\d*)$", self.headers.get("Range", ""))
+        if not m:
+            return None
+
+        if_range = self.headers.get("If-Range")
+        if if_range and if_range not in (self.etag, self.last_modified):
+            return None
+
+        start, end = m.groups()
+        if start == "":
+            start, end = size - int(end), size - 1
+        else:
+            start, end = int(start), int(end) if end else size - 1
+
+        return start, min(end, size - 1)
+
+    def do_HEAD(self):
+        time.sleep(self.server.latency)
+        fh, size = self._open()
+        if fh is None:
+            return
+        fh.close()
+        self.send_response(200)
+        self.send_header("Content-Length", str(size))
+        self.send_header("Accept-Ranges", "bytes")
+        self._send_validators()
+        self.end_headers()
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        fh, size = self._open()
+        if fh is None:
+            return
+
+        with fh:
+            r = self._range(size)
+            if r is None:
+                start, end = 0, size - 1
+                self.send_response(200)
+            elif r[0] > r[1]:
+                self.send_error(416)
+                return
+            else:
+                start, end = r
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes %s-%s/%s" % (start, end, size))
+
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            self._send_validators()
+            self.end_headers()
+
+            fh.seek(start)
+            self._send_body(fh, end - start + 1)
+
+    def _send_body(self, fh, remain):
+
+        if random.random() < self.server.fault:
+            remain = random.randint(0, remain - 1) if remain > 1 else 0
+            self.close_connection = True
+        rate = self.server.rate if random.random() < self.server.slow else 0
+        start = time.time()
+        sent = 0
+        while remain > 0:
+            data = fh.read(min(remain, 64*1024))
+            if not data:
+                break
+            try:
+                self.wfile.write(data)
+            except (IOError, OSError):
+                break
+            remain -= len(data)
+            sent += len(data)
+            if rate:
+                delay = sent / float(rate) - (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    latency = 0
+    rate = 0
+    slow = 1.0
+    fault = 0.0
+
+    def handle_error(self, request, client_address):
+        LOG.debug("Connection from %s closed" % (client_address,))
+
+
+class ServerProcess(object):
+    """
+    a server running in a child process, so its cpu time and memory are not
+    counted by Usage of the process measured
+    """
+
+    def __init__(self, process):
+        self.process = process
+
+    def shutdown(self):
+        self.process.terminate()
+        self.process.join()
+
+
+def _run_server(handler, root, port, kwargs, conn):
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.root = root
+    for k, v in kwargs.items():
+        setattr(server, k, v)
+    conn.send(server.server_address[1])
+    conn.close()
+    server.serve_forever()
+
+
+def _serve(handler, root, port, timeout=60, **kwargs):
+    """
+    :return: (ServerProcess, base url)
+    """
+    # fork needs no __main__ guard in scripts importing this module, spawn where fork is not available
+    ctx = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+    reader, writer = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_run_server, args=(handler, root, port, kwargs, writer))
+    process.daemon = True
+    process.start()
+    writer.close()
+    if not reader.poll(timeout):
+        process.terminate()
+        raise Exception("%s did not start in %ss" % (handler.__name__, timeout))
+    port = reader.recv()
+
+    return ServerProcess(process), "http://127.0.0.1:%s/" % port
+
+
+def start_http_server(root, port=0, latency=0, rate=0, fault=0.0, slow=1.0):
+    """
+    start a range capable http server in a child process
+    :param root: directory to serve
+    :param port: 0 for a random port
+    :param latency: seconds before each response
+    :param rate: bytes per second of each response, 0 for no limit
+    :param fault: probability to cut a response body
+    :param slow: probability of a response to be limited by rate
+    :return: server, base url
+    """
+    return _serve(RangeHandler, root, port, latency=latency, rate=rate, fault=fault, slow=slow)
+
+
+class ObsHandler(RangeHandler):
+    """
+    a path style OBS endpoint keeping objects under server.root/bucket/key,
+    implement what OBS uses: put, get, head, list, delete, append, copy and
+    multipart upload, signatures are not checked
+    """
+
+    def _split(self):
+        url = urlparse(self.path)
+        bucket, _, key = unquote(url.path).lstrip("/").partition("/")
+        query = dict((k, v[0]) for k, v in parse_qs(url.query, keep_blank_values=True).items())
+        return bucket, key, query
+
+    def _file(self, bucket, key):
+        return os.path.join(self.server.root, bucket, key)
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            r = []
+            while True:
+                n = int(self.rfile.readline().strip().split(b";")[0], 16)
+                if n == 0:
+                    self.rfile.readline()
+                    break
+                r.append(self.rfile.read(n))
+                self.rfile.readline()
+            return b"".join(r)
+
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body and self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _xml(self, root, items):
+        body = "".join("<%s>%s</%s>" % (k, v, k) for k, v in items)
+        self._reply(200, ("<?xml version=\"1.0\" encoding=\"UTF-8\"?><%s>%s</%s>" % (
+            root, body, root)).encode("utf-8"), {"Content-Type": "application/xml"})
+
+    def _write(self, path, data):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as fh:
+            fh.write(data)
+        self.server.etags[path] = '"%s"' % hashlib.md5(data).hexdigest()
+
+        return self.server.etags[path]
+
+    def _etag(self, path):
+        if path in self.server.etags:
+            return self.server.etags[path]
+        stat = os.stat(path)
+        return '"%x-%x"' % (int(stat.st_mtime * 1000000), stat.st_size)
+
+    @staticmethod
+    def _time(path):
+        return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(os.path.getmtime(path)))
+
+    def _uploads(self, upload_id=""):
+        return os.path.join(self.server.root, ".uploads", upload_id)
+
+    def _open(self):
+        bucket, key, query = self._split()
+        path = self._file(bucket, key)
+        if not key or not os.path.isfile(path):
+            self._reply(404)
+            return None, 0
+
+        stat = os.stat(path)
+        self.etag = self._etag(path)
+        self.last_modified = formatdate(stat.st_mtime, usegmt=True)
+        return open(path, "rb"), stat.st_size
+
+    def do_GET(self):
+        bucket, key, query = self._split()
+        if not key:
+            time.sleep(self.server.latency)
+            return self._list(bucket, query)
+        if "uploadId" in query:
+            time.sleep(self.server.latency)
+            return self._list_parts(bucket, key, query)
+        path = self._file(bucket, key)
+        if_match = self.headers.get("If-Match")
+        if if_match and os.path.isfile(path) and unquote(if_match).strip('"') != self._etag(path).strip('"'):
+            return self._reply(412)
+
+        RangeHandler.do_GET(self)
+
+    def _list(self, bucket, query):
+        root = os.path.join(self.server.root, bucket)
+        prefix = query.get("prefix", "")
+        marker = query.get("marker", "")
+        max_keys = int(query.get("max-keys", 1000))
+        keys = []
+        for path, dirs, files in os.walk(root):
+            for f in files:
+                key = os.path.relpath(os.path.join(path, f), root).replace(os.sep, "/")
+                if key.startswith(prefix) and key > marker:
+                    keys.append(key)
+        keys.sort()
+        page = keys[:max_keys]
+        items = [("Name", bucket), ("Prefix", escape(prefix)), ("Marker", escape(marker)), ("MaxKeys", max_keys),
+                 ("IsTruncated", "true" if len(keys) > max_keys else "false")]
+        if len(keys) > max_keys:
+            items.append(("NextMarker", escape(page[-1])))
+        for key in page:
+            path = self._file(bucket, key)
+            items.append(("Contents", "<Key>%s</Key><LastModified>%s</LastModified><ETag>%s</ETag><Size>%s</Size>" % (
+                escape(key), self._time(path), self._etag(path), os.path.getsize(path))))
+        self._xml("ListBucketResult", items)
+
+    def _list_parts(self, bucket, key, query):
+        folder = self._uploads(query["uploadId"])
+        if not os.path.isdir(folder):
+            return self._reply(404)
+        marker = int(query.get("part-number-marker", 0))
+        max_parts = int(query.get("max-parts", 1000))
+        nums = sorted(int(i) for i in os.listdir(folder) if int(i) > marker)
+        page = nums[:max_parts]
+        items = [("Bucket", bucket), ("Key", escape(key)), ("UploadId", query["uploadId"]),
+                 ("PartNumberMarker", marker), ("MaxParts", max_parts),
+                 ("IsTruncated", "true" if len(nums) > max_parts else "false")]
+        if len(nums) > max_parts:
+            items.append(("NextPartNumberMarker", page[-1]))
+        for n in page:
+            path = os.path.join(folder, str(n))
+            items.append(("Part", "<PartNumber>%s</PartNumber><LastModified>%s</LastModified><ETag>%s</ETag>"
+                                  "<Size>%s</Size>" % (n, self._time(path), self._etag(path), os.path.getsize(path))))
+        self._xml("ListPartsResult", items)
+
+    def do_PUT(self):
+        bucket, key, query = self._split()
+        time.sleep(self.server.latency)
+        data = self._read_body()
+        if key.endswith("/"):
+            # folder marker like OBS.mkdir puts
+            path = self._file(bucket, key)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            return self._reply(200, headers={"ETag": '"%s"' % hashlib.md5(data).hexdigest()})
+        source = self.headers.get("x-obs-copy-source") or self.headers.get("x-amz-copy-source")
+        if "uploadId" in query:
+            folder = self._uploads(query["uploadId"])
+            if not os.path.isdir(folder):
+                return self._reply(404)
+            if not source:
+                etag = self._write(os.path.join(folder, str(int(query["partNumber"]))), data)
+                return self._reply(200, headers={"ETag": etag})
+            # copyPart
+            src = self._file(*unquote(source).lstrip("/").split("/", 1))
+            if not os.path.isfile(src):
+                return self._reply(404)
+            span = self.headers.get("x-obs-copy-source-range") or self.headers.get("x-amz-copy-source-range")
+            start, end = span.split("=", 1)[1].split("-") if span else (0, os.path.getsize(src) - 1)
+            with open(src, "rb") as fh:
+                fh.seek(int(start))
+                data = fh.read(int(end) - int(start) + 1)
+            etag = self._write(os.path.join(folder, str(int(query["partNumber"]))), data)
+            return self._xml("CopyPartResult", [("LastModified", self._time(src)), ("ETag", etag)])
+
+        if source:
+            src = self._file(*unquote(source).lstrip("/").split("/", 1))
+            if not os.path.isfile(src):
+                return self._reply(404)
+            with open(src, "rb") as fh:
+                data = fh.read()
+            etag = self._write(self._file(bucket, key), data)
+            return self._xml("CopyObjectResult", [("LastModified", self._time(src)), ("ETag", etag)])
+
+        self._reply(200, headers={"ETag": self._write(self._file(bucket, key), data)})
+
+    def do_POST(self):
+        bucket, key, query = self._split()
+        time.sleep(self.server.latency)
+        data = self._read_body()
+        if "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            os.makedirs(self._uploads(upload_id))
+            return self._xml("InitiateMultipartUploadResult", [
+                ("Bucket", bucket), ("Key", escape(key)), ("UploadId", upload_id)])
+
+        if "uploadId" in query:
+            folder = self._uploads(query["uploadId"])
+            if not os.path.isdir(folder):
+                return self._reply(404)
+            path = self._file(bucket, key)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            digests = []
+            with open(path, "wb") as out:
+                for node in ElementTree.fromstring(data).findall("Part"):
+                    part = os.path.join(folder, node.find("PartNumber").text)
+                    digests.append(binascii.unhexlify(self.server.etags.pop(part).strip('"')))
+                    with open(part, "rb") as fh:
+                        shutil.copyfileobj(fh, out)
+            shutil.rmtree(folder)
+            self.server.etags[path] = '"%s-%s"' % (hashlib.md5(b"".join(digests)).hexdigest(), len(digests))
+            return self._xml("CompleteMultipartUploadResult", [
+                ("Bucket", bucket), ("Key", escape(key)), ("ETag", self._etag(path))])
+
+        if "append" in query:
+            path = self._file(bucket, key)
+            size = os.path.getsize(path) if os.path.isfile(path) else 0
+            if int(query.get("position", 0)) != size:
+                return self._reply(409)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "ab") as fh:
+                fh.write(data)
+            self.server.etags.pop(path, None)
+            return self._reply(200, headers={"ETag": self._etag(path), "x-obs-next-append-position": str(
+                size + len(data))})
+
+        self._reply(405)
+
+    def do_DELETE(self):
+        bucket, key, query = self._split()
+        if "uploadId" in query:
+            shutil.rmtree(self._uploads(query["uploadId"]), ignore_errors=True)
+        elif os.path.isfile(self._file(bucket, key)):
+            os.remove(self._file(bucket, key))
+            self.server.etags.pop(self._file(bucket, key), None)
+        self._reply(204)
+
+
+def start_obs_server(root, port=0, latency=0):
+    """
+    start a local OBS endpoint in a child process, use it with OBS(server=url)
+    :param root: directory to keep objects
+    :param port: 0 for a random port
+    :param latency: seconds before each response
+    :return: server, endpoint url
+    """
+    return _serve(ObsHandler, root, port, latency=latency, etags={})
+
+
+def create_file(path, size):
+
+    block = os.urandom(1024*1024)
+    with open(path, "wb") as fh:
+        while size > 0:
+            fh.write(block[:size])
+            size -= len(block)
+
+    return path
+
+
+class Usage(object):
+    """
+    wall time, cpu time and peak rss of the process in a with block
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.seconds = 0
+        self.cpu = 0
+        self.memory = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def rss():
+        try:
+            with open("/proc/self/statm") as fh:
+                return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (IOError, OSError, ValueError):
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            self.memory = max(self.memory, self.rss())
+
+    def __enter__(self):
+        self.memory = self.rss()
+        self.thread = threading.Thread(target=self._sample)
+        self.thread.daemon = True
+        self.thread.start()
+        self.times = os.times()
+        self.start = time.time()
+
+        return self
+
+    def __exit__(self, *args):
+        self.seconds = time.time() - self.start
+        times = os.times()
+        self.cpu = times[0] + times[1] - self.times[0] - self.times[1]
+        self.stopped.set()
+        self.thread.join()
+        self.memory = max(self.memory, self.rss())
+
+    def row(self, scenario, size_mb, **kwargs):
+        r = OrderedDict([("scenario", scenario), ("size_mb", size_mb)])
+        r.update(sorted(kwargs.items()))
+        r.update([
+            ("seconds", round(self.seconds, 2)),
+            ("MB/s", round(size_mb / self.seconds, 2) if self.seconds else 0),
+            ("cpu", round(self.cpu, 2)),
+            ("memory_mb", round(self.memory / 1024.0 / 1024, 1))
+        ])
+        LOG.info(" ".join("%s=%s" % i for i in r.items()))
+
+        return r
+
+
+def bench_download(size_mb=256, threads=(1, 2, 4, 8), latency=0, rate=0, fault=0.0, slow=1.0):
+    """
+    download a local file with different threads
+    :param size_mb: file size in Mb
+    :param threads: list of threads
+    :param latency: seconds before each response of the origin
+    :param rate: bytes per second of each response, 0 for no limit
+    :param fault: probability to cut a response body
+    :param slow: probability of a response to be limited by rate
+    :return: list of rows
+    """
+    root = tempfile.mkdtemp(prefix="hwget_bench_")
+    try:
+        expected = file_md5(create_file(os.path.join(root, "data.bin"), size_mb*1024*1024))
+        server, url = start_http_server(root, latency=latency, rate=rate, fault=fault, slow=slow)
+        r = []
+        for n in threads:
+            out = os.path.join(root, "out.bin")
+            if os.path.exists(out):
+                os.remove(out)
+            downloader = Downloader(threads=n, min_segment_size=1024*1024)
+            with Usage() as usage:
+                code = downloader.download(url + "data.bin", out, retry=100)
+            if code:
+                raise Exception("Download with %s threads failed" % n)
+            if file_md5(out) != expected:
+                raise Exception("Download with %s threads differs from the source" % n)
+            r.append(usage.row("download", size_mb, threads=n))
+        server.shutdown()
+    finally:
+        shutil.rmtree(root)
+
+    return r
+
+
+def bench_upload(size_mb=256, part_sizes=(0,), threads=(1, 2, 4, 8), latency=0):
+    """
+    upload a local file to a local OBS endpoint
+    :param size_mb: file size in Mb
+    :param part_sizes: list of part size in Mb, 0 to choose by file size
+    :param threads: list of threads
+    :param latency: seconds before each response of the endpoint
+    :return: list of rows
+    """
+    root = tempfile.mkdtemp(prefix="hwget_bench_")
+    try:
+        path = create_file(os.path.join(root, "data.bin"), size_mb*1024*1024)
+        os.makedirs(os.path.join(root, "obs", "bench"))
+        server, endpoint = start_obs_server(os.path.join(root, "obs"), latency=latency)
+        obs = OBS("ak", "sk", "local", server=endpoint)
+        r = []
+        for part_mb in part_sizes:
+            for n in threads:
+                with Usage() as usage:
+                    obs.upload("bench", "data.bin", path, part_size=part_mb*1024*1024 or None, threads=n)
+                r.append(usage.row("upload", size_mb, part_mb=part_mb, threads=n))
+        server.shutdown()
+    finally:
+        shutil.rmtree(root)
+
+    return r
+
+
+def bench_pipeline(size_mb=256, files=4, threads=(1, 4), part_sizes=(0,), stream=False, latency=0, rate=0,
+                   fault=0.0):
+    """
+    run the server pipeline from a local origin to a local OBS endpoint,
+    as do_download does on a server
+    :param size_mb: size of each file in Mb
+    :param files: number of files
+    :param threads: list of download threads
+    :param part_sizes: list of part size in Mb, 0 to choose by file size
+    :param stream: upload without writing local disk
+    :return: list of rows
+    """
+    root = tempfile.mkdtemp(prefix="hwget_bench_")
+    try:
+        os.makedirs(os.path.join(root, "www"))
+        os.makedirs(os.path.join(root, "obs", "bench"))
+        outs = ["data%s.bin" % i for i in range(files)]
+        for out in outs:
+            create_file(os.path.join(root, "www", out), size_mb*1024*1024)
+        http, url = start_http_server(os.path.join(root, "www"), latency=latency, rate=rate, fault=fault)
+        server, endpoint = start_obs_server(os.path.join(root, "obs"))
+        r = []
+        for part_mb in part_sizes:
+            for n in threads:
+                obs, downloader, scheduler = create_scheduler({
+                    "ak": "ak", "sk": "sk", "region": "local", "server": endpoint, "bucket": "bench",
+                    "download_threads": n, "files": files, "stream": stream,
+                    "part_size": part_mb*1024*1024 or None
+                })
+                downloader.min_segment_size = 1024*1024
+                workdir = tempfile.mkdtemp(dir=root)
+                with Usage() as usage:
+                    results = scheduler.run([url + o for o in outs], outs, workdir, "run%s_%s" % (part_mb, n))
+                if len(results) != files:
+                    raise Exception("Pipeline with %s threads failed" % n)
+                r.append(usage.row("pipeline", size_mb * files, files=files, part_mb=part_mb, threads=n,
+                                   stream=stream))
+        http.shutdown()
+        server.shutdown()
+    finally:
+        shutil.rmtree(root)
+
+    return r
+
+
+def file_md5(file, size=10*1024*1024):
+    """
+    md5 of a file by a second full read, as done before checksums were
+    computed over the parts read for upload
+    """
+    r = hashlib.md5()
+    with open(file, "rb") as fh:
+        while True:
+            d = fh.read(size)
+            if not d:
+                break
+            r.update(d)
+
+    return r.hexdigest()
+
+
+def _read_parts(path, part_size, checksum=None):
+    """
+    read path as OBS.upload does, with the md5 header of each part
+    """
+    for data in OBS._read(path, part_size):
+        base64.b64encode(hashlib.md5(data).digest())
+        if checksum is not None:
+            checksum.update(data)
+
+
+def bench_checksum(size_mb=1024, part_size=20*1024*1024):
+    """
+    compare md5 by a second full read with md5 computed inline over the
+    parts read for upload, both include the md5 of each part
+    :param size_mb: file size in Mb
+    :param part_size:
+    :return: seconds of (second read, inline, saved per Gb)
+    """
+    root = tempfile.mkdtemp(prefix="hwget_bench_")
+    try:
+        path = create_file(os.path.join(root, "data.bin"), size_mb*1024*1024)
+
+        start = time.time()
+        _read_parts(path, part_size)
+        expected = file_md5(path)
+        second_read = time.time() - start
+
+        start = time.time()
+        checksum = Checksum()
+        _read_parts(path, part_size, checksum)
+        inline = time.time() - start
+        if checksum.hexdigest()["md5"] != expected:
+            raise Exception("Inline md5 %s differs from %s of a full read" % (checksum.hexdigest()["md5"], expected))
+    finally:
+        shutil.rmtree(root)
+
+    saved = (second_read - inline) / (size_mb / 1024.0)
+    LOG.info("second read %.2fs, inline %.2fs, saved %.2fs/Gb" % (second_read, inline, saved))
+
+    return second_read, inline, saved
+
+
+def add_args(parser):
+
+    parser.add_argument("--scenario", nargs="+", default=["download"],
+                        choices=["download", "upload", "pipeline", "checksum"], help="scenarios to run")
+    parser.add_argument("--size", type=int, default=256, help="file size in Mb, default: 256")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8], help="download or upload threads")
+    parser.add_argument("--part-size", type=int, nargs="+", default=[0],
+                        help="part size in Mb, default: 0 to choose by file size")
+    parser.add_argument("--files", type=int, default=4, help="files of pipeline, default: 4")
+    parser.add_argument("--stream", action="store_true", help="pipeline uploads without writing local disk")
+    parser.add_argument("--latency", type=float, default=0, help="seconds before each response of servers")
+    parser.add_argument("--rate", type=float, default=0, help="Mb per second of each origin response, 0 for no limit")
+    parser.add_argument("--fault", type=float, default=0, help="probability to cut an origin response")
+    parser.add_argument("--slow", type=float, default=1.0,
+                        help="probability of an origin response to be limited by --rate, default: 1")
+
+    return parser
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""
+    description:
+    Benchmark transfer throughput against local servers
+""")
+
+    parser = add_args(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s [%(levelname)s] %(message)s')
+
+    rate = int(args.rate * 1024 * 1024)
+    rows = []
+    for scenario in args.scenario:
+        if scenario == "checksum":
+            print("second_read\tinline\tsaved_per_Gb")
+            print("%.2f\t%.2f\t%.2f" % bench_checksum(args.size))
+        elif scenario == "download":
+            rows += bench_download(args.size, args.threads, args.latency, rate, args.fault, args.slow)
+        elif scenario == "upload":
+            rows += bench_upload(args.size, args.part_size, args.threads, args.latency)
+        else:
+            rows += bench_pipeline(args.size, args.files, args.threads, args.part_size, args.stream, args.latency,
+                                   rate, args.fault)
+
+    if rows:
+        metrics = ["seconds", "MB/s", "cpu", "memory_mb"]
+        keys = []
+        for row in rows:
+            keys += [k for k in row if k not in keys and k not in metrics]
+        keys += metrics
+        print("\t".join(keys))
+        for row in rows:
+            print("\t".join(str(row.get(k, "-")) for k in keys))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import sys
+import logging
+import argparse
+from datetime import datetime
+
+from hwget.base import OBS, Hwget, Downloader
+from hwget.aio import AsyncDownloader
+from hwget.state import State
+from hwget.server import read_cfg
+from hwget.version import __version__
+
+
+LOG = logging.getLogger(__name__)
+
+
+def add_fetch_args(parser):
+
+    parser.add_argument("cfg", help="config with ak, sk, region and bucket, like the server config")
+    parser.add_argument("folder", help="date/uid of the files in bucket")
+    parser.add_argument("-o", "--out", default=".", help="output directory, default: .")
+    parser.add_argument("--threads", type=int, default=8, help="ranged GETs of one object at the same time, default: 8")
+    parser.add_argument("--files", type=int, default=4, help="objects downloaded at the same time, default: 4")
+    parser.add_argument("--part-size", type=int, default=16, help="bytes of each range in Mb, default: 16")
+    parser.add_argument("--no-verify", action="store_true", help="do not check files against the md5 manifests")
+
+    return parser
+
+
+def do_fetch(args):
+
+    cfg = read_cfg(args.cfg)
+    obs = OBS(ak=cfg["ak"], sk=cfg["sk"], region=cfg["region"], server=cfg.get("server"))
+    failed = obs.fetch(cfg["bucket"], args.folder, args.out, threads=args.threads, files=args.files,
+                       part_size=args.part_size * 1024 * 1024, verify=not args.no_verify)
+
+    return 1 if failed else 0
+
+
+def add_batch_args(parser):
+
+    parser.add_argument("cfg", help="config with ak, sk, region, project_id, bucket and image")
+    parser.add_argument("manifest", nargs="?", help="tsv of url and out, mirrors of a url are separated by spaces")
+    parser.add_argument("--state", default="hwget.db", help="sqlite state file, default: hwget.db")
+    parser.add_argument("--batch", type=int, default=1000, help="files of each job, default: 1000")
+    parser.add_argument("--probe-batch", type=int, default=1000, help="urls probed at the same time, default: 1000")
+    parser.add_argument("--retry", action="store_true", help="probe and submit failed and unreachable files again")
+    parser.add_argument("--probe-only", action="store_true", help="load and probe, do not submit")
+    parser.add_argument("--workers", type=int, default=1, help="servers of each job, default: 1")
+    parser.add_argument("--files", type=int, default=4, help="files of each server at the same time, default: 4")
+    parser.add_argument("--download-threads", type=int, default=4, help="connections of one file, default: 4")
+    parser.add_argument("--upload-threads", type=int, default=4, help="parts of one file uploaded at the same time")
+    parser.add_argument("--stream", action="store_true", help="upload while downloading without local disk")
+    parser.add_argument("--use-worker", action="store_true", help="submit to the queue when a worker is alive")
+
+    return parser
+
+
+def _entry(url):
+    """
+    :param url: mirrors separated by spaces, as kept in State
+    :return: url or list of mirrors, as Hwget.get takes
+    """
+    urls = url.split()
+
+    return urls if len(urls) > 1 else urls[0]
+
+
+def probe(state, batch=1000):
+    """
+    probe rows not probed yet, batch by batch
+    :param state: State
+    :param batch:
+    :return:
+    """
+    while True:
+        rows = state.to_probe(batch)
+        if not rows:
+            break
+        try:
+            downloader = AsyncDownloader()
+        except Exception:
+            downloader = Downloader()
+        try:
+            downloader.probe_all([m for i, url in rows for m in url.split()], threads=32)
+            r = []
+            for i, url in rows:
+                meta = downloader.probe(_entry(url))
+                r.append((i, meta["size"] if meta else None,
+                          dict((u, downloader.meta[u]) for u in url.split() if u in downloader.meta)))
+        finally:
+            if isinstance(downloader, AsyncDownloader):
+                downloader.close()
+        state.set_probed(r)
+        LOG.info("Probe %s urls, %s" % (len(rows), state.counts()))
+
+
+def submit(cloud, state, name, args):
+    """
+    run a job of the rows assigned to it and record the result
+    :return: list outs failed
+    """
+    rows = state.job_files(name)
+    meta = {}
+    for i, url, out, size, m in rows:
+        meta.update(m)
+    LOG.info("Job {:}: {:,} files of {:,} bytes".format(name, len(rows), sum(r[3] for r in rows)))
+    failed = cloud.get([_entry(r[1]) for r in rows], [r[2] for r in rows], workers=args.workers, files=args.files,
+                       download_threads=args.download_threads, upload_threads=args.upload_threads,
+                       stream=args.stream, use_worker=args.use_worker, meta=meta, folder=name,
+                       launched=lambda servers, queued: state.set_tasks(name, servers, queued))
+    state.finish_job(name, failed)
+
+    return failed
+
+
+def resume(cloud, state, name, args):
+    """
+    wait on the servers or queued tasks recorded for a job interrupted, run
+    it again when none of them is left. files of the folder are skipped
+    :return: list outs failed
+    """
+    tasks = state.job_tasks(name)
+    failed = None
+    if tasks is not None:
+        servers, queued = tasks
+        failed = cloud.resume(servers, cloud.bucket, name, [r[2] for r in state.job_files(name)], queued)
+    if failed is None:
+        return submit(cloud, state, name, args)
+    state.finish_job(name, failed)
+
+    return failed
+
+
+def do_batch(args):
+
+    cfg = read_cfg(args.cfg)
+    state = State(args.state)
+    rejected = []
+    if args.manifest:
+        with open(args.manifest) as fh:
+            rejected = state.load(fh)[2]
+    if args.retry:
+        LOG.info("Retry %s files" % state.retry(("failed", "unreachable")))
+    probe(state, args.probe_batch)
+    if args.probe_only:
+        LOG.info("Files: %s" % state.counts())
+        return 1 if rejected else 0
+
+    options = dict((k, cfg[k]) for k in ("image", "cache_file", "wheels") if k in cfg)
+    cloud = Hwget(ak=cfg["ak"], sk=cfg["sk"], region=cfg["region"], project_id=cfg["project_id"],
+                  bucket=cfg["bucket"], **options)
+    for name in state.running_jobs():
+        resume(cloud, state, name, args)
+
+    while True:
+        rows = state.ready(args.batch)
+        if not rows:
+            break
+        name = "%s/%s" % (datetime.utcnow().strftime('%Y%m%d'), Hwget._generate_id([_entry(r[1]) for r in rows]))
+        state.start_job(name, [r[0] for r in rows])
+        submit(cloud, state, name, args)
+
+    counts = state.counts()
+    LOG.info("Files: %s" % counts)
+    if rejected:
+        LOG.error("%s rows of the manifest rejected, their outputs belong to other urls" % len(rejected))
+    return 1 if counts.get("failed") or counts.get("unreachable") or rejected else 0
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        stream=sys.stderr,
+        format='%(asctime)s [%(levelname)s] %(message)s',
+        datefmt='%d %b %Y %H:%M:%S'
+    )
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""
+    description:
+    Command line of hwget
+""")
+    parser.add_argument("--version", action="version", version="hwget %s" % __version__)
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    fetch = subparsers.add_parser("fetch", help="download files of a job from OBS, resume and verify them")
+    add_fetch_args(fetch).set_defaults(func=do_fetch)
+    batch = subparsers.add_parser("batch", help="download files of a tsv manifest in jobs, state is kept in sqlite")
+    add_batch_args(batch).set_defaults(func=do_batch)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
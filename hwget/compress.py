@@ -0,0 +1,114 @@
+# -*- coding:utf-8 -*-
+"""
+compress a stream of bytes in blocks on threads, blocks are independent so
+the output is gzip compatible BGZF, or concatenated zstd frames
+"""
+import os
+import zlib
+import struct
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOG = logging.getLogger(__name__)
+
+# suffix of output compressed by each method
+METHODS = {"bgzf": ".gz", "zstd": ".zst"}
+# outputs with these suffixes are compressed already
+COMPRESSED = (".gz", ".bgz", ".bz2", ".xz", ".zst", ".zip", ".7z", ".bam", ".cram", ".bcf")
+BGZF_BLOCK_SIZE = 65280
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+ZSTD_BLOCK_SIZE = 4*1024*1024
+
+
+def output_name(out, method):
+    """
+    :return: out with the suffix of method, out if it is compressed already
+    """
+    if method not in METHODS:
+        raise Exception("Compression %r not supported, choose from %s" % (method, sorted(METHODS)))
+    if out.lower().endswith(COMPRESSED):
+        return out
+
+    return out + METHODS[method]
+
+
+def original_name(out, method):
+
+    return out[:-len(METHODS[method])]
+
+
+def _bgzf_block(data, level):
+    """
+    a BGZF block is a gzip member with the block size in an extra field
+    """
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = c.compress(data) + c.flush()
+    header = struct.pack("<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(deflated) + 25)
+
+    return header + deflated + struct.pack("<2I", zlib.crc32(data) & 0xffffffff, len(data))
+
+
+def _bgzf(data, level):
+
+    return b"".join(_bgzf_block(data[i:i + BGZF_BLOCK_SIZE], level) for i in range(0, len(data), BGZF_BLOCK_SIZE))
+
+
+def _zstd(data, level):
+
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _blocks(chunks, size, checksum=None):
+
+    buf = bytearray()
+    for chunk in chunks:
+        if checksum is not None:
+            checksum.update(chunk)
+        buf += chunk
+        while len(buf) >= size:
+            yield bytes(buf[:size])
+            del buf[:size]
+    if buf:
+        yield bytes(buf)
+
+
+def compress(chunks, method="bgzf", threads=None, level=None, checksum=None):
+    """
+    zlib and zstandard release the GIL, so blocks are compressed on threads,
+    no more than 2 * threads blocks are held in memory
+    :param chunks: iterable of bytes
+    :param method: bgzf or zstd
+    :param threads: 压缩线程数, 默认为 CPU 数
+    :param level: 压缩级别, bgzf 默认 6, zstd 默认 3
+    :param checksum: Checksum updated with the bytes before compression
+    :return: generator of compressed bytes in order
+    """
+    if method == "bgzf":
+        func, size, level = _bgzf, BGZF_BLOCK_SIZE * 16, 6 if level is None else level
+    elif method == "zstd":
+        if zstandard is None:
+            e = "zstandard is required for zstd, pip install zstandard"
+            LOG.error(e)
+            raise Exception(e)
+        func, size, level = _zstd, ZSTD_BLOCK_SIZE, 3 if level is None else level
+    else:
+        raise Exception("Compression %r not supported, choose from %s" % (method, sorted(METHODS)))
+
+    threads = threads or os.cpu_count() or 1
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for block in _blocks(chunks, size, checksum):
+            pending.append(executor.submit(func, block, level))
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    if method == "bgzf":
+        yield BGZF_EOF
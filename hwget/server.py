@@ -2,37 +2,937 @@
 # -*- coding:utf-8 -*-
 
 import os
+import io
 import json
-import hashlib
+import time
+import shutil
+import socket
+import tarfile
 import logging
 import argparse
+import threading
+import queue
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-from hwget.base import OBS, Downloader
+from hwget.base import OBS, Downloader, Checksum, Journal, TaskQueue, Metrics, DedupIndex
+from hwget.aio import AsyncDownloader
+from hwget.compress import compress, original_name
 
 
 LOG = logging.getLogger(__name__)
+SMALL_SIZE = 8*1024*1024
 
 
-def create_md5(file):
+def stream_file(downloader, obs, bucket, url, target, upload_threads=4, checksum=None, download_callback=None,
+                upload_callback=None, part_size=None, method=None, compress_threads=None, original=None):
+    """
+    download url straight into obs without writing local disk
+    :param part_size: 默认按文件大小选择
+    :param download_callback: function called with bytes count of each chunk downloaded
+    :param upload_callback: function called with bytes count of each part uploaded
+    :param method: 压缩方法 bgzf 或 zstd, 默认不压缩, checksum 为压缩后的值
+    :param compress_threads: 压缩线程数
+    :param original: Checksum of the content before compression
+    :return: target
+    """
+    def chunks():
+        for chunk in downloader.stream(url):
+            download_callback(len(chunk))
+            yield chunk
+
+    meta = downloader.probe(url)
+    content = chunks() if download_callback else downloader.stream(url)
+    size = meta["size"] if meta else None
+    if method:
+        content = compress(content, method, compress_threads, checksum=original)
+        size = None
+    return obs.upload_stream(bucket, target, content,
+                             part_size=part_size, threads=upload_threads, checksum=checksum,
+                             callback=upload_callback, size=size)
+
+
+class Progress(object):
+    """
+    progress of a task, published as a small json object overwritten in
+    place, so the client polls one object instead of listing the folder
+    {
+        "state": "running",
+        "time": 1600000000.0,
+        "files": {
+            target: {"size": 0, "downloaded": 0, "uploaded": 0, "rate": 0.0, "state": "queued"}
+        }
+    }
+    """
+
+    def __init__(self, obs, bucket, target, interval=10):
+        """
+
+        :param obs: OBS
+        :param bucket:
+        :param target: progress object
+        :param interval: 发布间隔 秒
+        """
+        self.obs = obs
+        self.bucket = bucket
+        self.target = target
+        self.interval = interval
+        self.state = "running"
+        self.files = OrderedDict()
+        self.last = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.first_byte = None
+
+    def add(self, target, size, state="queued"):
+
+        with self.lock:
+            self.files[target] = {"size": size, "downloaded": 0, "uploaded": 0, "rate": 0.0, "state": state}
+
+    def set_state(self, target, state):
+
+        with self.lock:
+            self.files[target]["state"] = state
+
+    def add_bytes(self, target, name, n):
+        """
+
+        :param target:
+        :param name: downloaded or uploaded
+        :param n:
+        :return:
+        """
+        with self.lock:
+            if self.first_byte is None and name == "downloaded":
+                self.first_byte = time.time()
+            self.files[target][name] += n
+
+    def callback(self, target, name):
+
+        return lambda n: self.add_bytes(target, name, n)
+
+    def snapshot(self):
+
+        now = time.time()
+        with self.lock:
+            files = OrderedDict()
+            for target, v in self.files.items():
+                v = dict(v)
+                done = v["downloaded"] + v["uploaded"]
+                last_time, last_done = self.last.get(target, (now, done))
+                if now > last_time:
+                    v["rate"] = round((done - last_done) / (now - last_time), 1)
+                self.last[target] = (now, done)
+                files[target] = v
+
+        return {"state": self.state, "time": now, "files": files}
+
+    def publish(self):
+
+        try:
+            if self.obs.put(self.bucket, self.target, json.dumps(self.snapshot())):
+                LOG.warning("Publish progress %r failed" % self.target)
+        except Exception as e:
+            LOG.warning("Publish progress %r failed. %s" % (self.target, e))
+
+    def _run(self):
+
+        while not self.stopped.wait(self.interval):
+            self.publish()
+
+    def start(self):
+
+        self.publish()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, state="finished"):
+
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.state = state
+        self.publish()
+
+
+class Budget(object):
+    """
+    counting semaphore acquired by weight, like connections or bytes
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.free = total
+        self.cond = threading.Condition()
+
+    def acquire(self, n):
+        """
+        wait until n is free, n larger than total is cut to total
+        :return: n acquired
+        """
+        n = min(n, self.total)
+        with self.cond:
+            while self.free < n:
+                self.cond.wait()
+            self.free -= n
+
+        return n
+
+    def release(self, n):
+        with self.cond:
+            self.free += n
+            self.cond.notify_all()
+
+
+class Packer(object):
+    """
+    bundle small files into local tar shards, a shard is returned to upload
+    when it reaches shard_size. {key}.idx holds "out\toffset\tsize" of each
+    member, offset of its content in the shard, for range reads
+    """
+
+    def __init__(self, workdir, prefix, name, shard_size=1024*1024*1024):
+        """
+
+        :param workdir: 本地目录
+        :param prefix: obs 目录, shards are put under {prefix}/packs/
+        :param name: task name
+        :param shard_size: 单个 tar 字节数上限
+        """
+        self.workdir = workdir
+        self.prefix = prefix
+        self.name = "%s.%s" % (name, datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+        self.shard_size = shard_size
+        self.lock = threading.Lock()
+        self.n = 0
+        self.path = None
+        self.tar = None
+        self.members = []
+
+    def _detach(self):
+        """
+        :return: (path, key, members) of the current shard, members are [(out, offset, size, checksum, disk_bytes)]
+        """
+        self.tar.close()
+        shard = (self.path, "%s/packs/%s" % (self.prefix, os.path.basename(self.path)), self.members)
+        self.tar = None
+        self.members = []
+
+        return shard
+
+    def add(self, file_path, out, checksum, disk_bytes=0):
+        """
+        append file_path as out to the current shard
+        :param checksum: Checksum updated with content of file_path
+        :param disk_bytes: disk bytes held by the file, released when the shard is uploaded
+        :return: shard to upload when full, or None
+        """
+        with open(file_path, "rb") as fh:
+            data = fh.read()
+        checksum.update(data)
+        info = tarfile.TarInfo(out)
+        info.size = len(data)
+        info.mtime = time.time()
+
+        with self.lock:
+            if self.tar is None:
+                self.n += 1
+                self.path = os.path.join(self.workdir, "%s.%s.tar" % (self.name, self.n))
+                self.tar = tarfile.open(self.path, "w", format=tarfile.PAX_FORMAT)
+            self.tar.addfile(info, io.BytesIO(data))
+            # content is padded to blocks after the header
+            offset = self.tar.offset - -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            self.members.append((out, offset, len(data), checksum, disk_bytes))
+            if self.tar.offset >= self.shard_size:
+                return self._detach()
+
+        return None
+
+    def close(self):
+        """
+        :return: the last shard to upload, or None
+        """
+        with self.lock:
+            return self._detach() if self.tar is not None else None
+
+
+class Scheduler(object):
+    """
+    download and upload files of a task concurrently, largest first, under
+    global limits on connections, in-flight upload bytes and local disk.
+    downloads of later files overlap with uploads of finished ones
+    """
+
+    def __init__(self, downloader, obs, bucket, files=4, connections=32, upload_threads=4,
+                 upload_bytes=512*1024*1024, disk_bytes=None, part_size=None, stream=False,
+                 algorithms=("md5",), uploads=2, queue_size=4, pack_size=0, shard_size=1024*1024*1024,
+                 compress_threads=None):
+        """
+
+        :param downloader: Downloader
+        :param obs: OBS
+        :param bucket:
+        :param files: 同时处理的文件数
+        :param connections: 全局连接数上限
+        :param upload_threads: 单个文件同时上传的分段数
+        :param upload_bytes: 全局上传缓存字节数上限
+        :param disk_bytes: 本地磁盘字节数上限, 默认为当前目录可用空间
+        :param part_size: 默认按文件大小选择
+        :param stream: 不落盘直接上传
+        :param algorithms: checksums
+        :param uploads: 同时上传的文件数
+        :param queue_size: 已下载待上传的文件数上限
+        :param pack_size: 不超过该字节数的文件打包到 tar 中上传, 0 不打包, 不适用于 stream
+        :param shard_size: 单个 tar 字节数上限, 不超过磁盘上限的一半
+        :param compress_threads: 压缩线程数, 默认为 CPU 数
+        """
+        self.downloader = downloader
+        self.obs = obs
+        self.bucket = bucket
+        self.files = max(files, 1)
+        self.uploads = max(uploads, 1)
+        self.queue_size = max(queue_size, 1)
+        self.upload_threads = upload_threads
+        self.part_size = part_size
+        self.stream = stream
+        self.algorithms = algorithms
+        self.pack_size = pack_size
+        self.shard_size = shard_size
+        self.packer = None
+        self.prefix = None
+        self.packed = {}
+        self.shards = {}
+        self.compress_threads = compress_threads
+        self.methods = {}
+        self.originals = {}
+        self.journal = None
+        self.progress = None
+        self.metrics = Metrics()
+
+        if disk_bytes is None:
+            disk_bytes = shutil.disk_usage(".").free
+        self.connections = Budget(connections)
+        self.upload_bytes = Budget(upload_bytes)
+        self.disk_bytes = Budget(disk_bytes)
+
+    def _callback(self, target, name):
+
+        return self.progress.callback(target, name) if self.progress is not None else None
+
+    def _state(self, target, state):
+
+        if self.progress is not None:
+            self.progress.set_state(target, state)
+
+    def _part_size(self, size):
+
+        return self.obs.part_size_for(size, self.part_size, self.upload_threads)
+
+    def _upload(self, file_path, target, checksum):
+
+        part_size = self._part_size(os.path.getsize(file_path))
+        connections = self.connections.acquire(self.upload_threads)
+        upload_bytes = self.upload_bytes.acquire(part_size * (self.upload_threads + 1))
+        self._state(target, "uploading")
+        method = self.methods.get(target)
+        try:
+            with self.metrics.timer("upload", target):
+                if method:
+                    original = Checksum(self.algorithms)
+                    self.obs.upload_stream(self.bucket, target,
+                                           compress(self.obs._read(file_path, Downloader.CHUNK_SIZE), method,
+                                                    self.compress_threads, checksum=original),
+                                           part_size=part_size, threads=self.upload_threads, checksum=checksum,
+                                           callback=self._callback(target, "uploaded"))
+                    self.originals[target] = original.hexdigest()
+                else:
+                    self.obs.upload(self.bucket, target, file_path, part_size=part_size,
+                                    threads=self.upload_threads, checksum=checksum, journal=self.journal,
+                                    callback=self._callback(target, "uploaded"))
+        finally:
+            self.upload_bytes.release(upload_bytes)
+            self.connections.release(connections)
+
+    def _download(self, url, file_path, target):
+
+        connections = self.connections.acquire(self.downloader.threads)
+        self._state(target, "downloading")
+        for u in self.downloader.mirrors(url):
+            self.metrics.alias(u, target)
+        try:
+            with self.metrics.timer("download", target):
+                return self.downloader.download(url, file_path, journal=self.journal,
+                                                callback=self._callback(target, "downloaded"))
+        finally:
+            self.connections.release(connections)
+
+    def _stream(self, url, target, checksum):
+
+        meta = self.downloader.probe(url)
+        part_size = self._part_size(meta["size"] if meta else None)
+        method = self.methods.get(target)
+        original = Checksum(self.algorithms) if method else None
+        connections = self.connections.acquire(self.downloader.threads + self.upload_threads)
+        upload_bytes = self.upload_bytes.acquire(part_size * (self.upload_threads + 1))
+        self._state(target, "streaming")
+        for u in self.downloader.mirrors(url):
+            self.metrics.alias(u, target)
+        try:
+            with self.metrics.timer("stream", target):
+                stream_file(self.downloader, self.obs, self.bucket, url, target, self.upload_threads, checksum,
+                            self._callback(target, "downloaded"), self._callback(target, "uploaded"), part_size,
+                            method, self.compress_threads, original)
+            if method:
+                self.originals[target] = original.hexdigest()
+        finally:
+            self.upload_bytes.release(upload_bytes)
+            self.connections.release(connections)
+
+    def _verify(self, file_path, target, size=None):
+        """
+        :param size: object size expected, default: size of file_path
+        """
+        if size is None:
+            size = os.path.getsize(file_path)
+        stat = self.obs.stat(self.bucket, target)
+        if stat is None or stat["size"] != size:
+            raise Exception("Object %r does not match local size %s: %s" % (target, size, stat))
+
+    def _done(self, target, checksum, shard=None):
+        """
+        record target finished
+        :param shard: key of the tar shard target is packed into
+        :return: dict {algorithm: hexdigest}
+        """
+        r = checksum.hexdigest()
+        self.metrics.add("bytes", checksum.size, target)
+        self.metrics.add("hash", checksum.seconds, target)
+        if self.journal is not None:
+            self.journal.update(target, done=r, original=self.originals.get(target), shard=shard)
+        self._state(target, "done")
+
+        return r
+
+    def _exists(self, key):
+        """
+        a packed target is never an object, its shard and the index of the shard are checked instead
+        """
+        if key not in self.shards:
+            self.shards[key] = self.obs.stat(self.bucket, key) is not None and \
+                self.obs.stat(self.bucket, key + ".idx") is not None
+
+        return self.shards[key]
+
+    def _is_done(self, target):
+        """
+        :return: dict {algorithm: hexdigest} recorded in journal if target is finished and exists, else None
+        """
+        if self.journal is None:
+            return None
 
-    r = hashlib.md5()
-    with open(file, "rb") as fh:
+        record = self.journal.get(target)
+        r = record.get("done")
+        if r is None or set(r) != set(self.algorithms):
+            return None
+        if record.get("shard"):
+            if not self._exists(record["shard"]):
+                return None
+            self.packed[target[len(self.prefix) + 1:]] = record["shard"]
+        elif self.obs.stat(self.bucket, target) is None:
+            return None
+        if target in self.methods:
+            if not record.get("original"):
+                return None
+            self.originals[target] = record["original"]
+
+        LOG.info("%r finished already" % target)
+        return r
+
+    def stream_file(self, url, target):
+        """
+        download url straight into target
+        :return: dict {algorithm: hexdigest} or None if failed
+        """
+        checksum = Checksum(self.algorithms)
+        try:
+            self._stream(url, target, checksum)
+        except Exception as e:
+            LOG.error("Stream %r failed: %s" % (target, e))
+            self._state(target, "failed")
+            return None
+
+        return self._done(target, checksum)
+
+    def download_file(self, url, file_path, target, size, done):
+        """
+        download url to file_path under the disk budget, then put it on the upload queue
+        :param done: queue of (file_path, target, disk bytes held)
+        :return:
+        """
+        disk_bytes = self.disk_bytes.acquire(size)
+        try:
+            code = self._download(url, file_path, target)
+        except Exception as e:
+            LOG.error("Download %r failed: %s" % (url, e))
+            code = 1
+
+        self._downloaded(code, file_path, target, disk_bytes, done)
+
+    def _downloaded(self, code, file_path, target, disk_bytes, done):
+        """
+        put a file downloaded on the upload queue, or remove it and release its disk if failed
+        """
+        if code:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            if self.journal is not None:
+                self.journal.remove(file_path)
+            self.disk_bytes.release(disk_bytes)
+            self._state(target, "failed")
+            return
+
+        self._state(target, "downloaded")
+        done.put((file_path, target, disk_bytes))
+
+    def _submit_small(self, jobs, workdir, prefix, finished):
+        """
+        start small files on the event loop under the disk budget, each is put on finished
+        as (future or None if not started, file_path, target, disk bytes held, start time) when it ends
+        """
+        for url, out, size in jobs:
+            file_path, target = os.path.join(workdir, out), "%s/%s" % (prefix, out)
+            disk_bytes = self.disk_bytes.acquire(size)
+            item = (file_path, target, disk_bytes, time.time())
+            try:
+                self._state(target, "downloading")
+                for u in self.downloader.mirrors(url):
+                    self.metrics.alias(u, target)
+                future = self.downloader.submit(url, file_path, callback=self._callback(target, "downloaded"))
+            except Exception as e:
+                LOG.error("Download %r failed: %s" % (url, e))
+                finished.put((None,) + item)
+                continue
+            future.add_done_callback(lambda f, item=item: finished.put((f,) + item))
+
+    def download_small(self, jobs, workdir, prefix, done):
+        """
+        download small files on the event loop of an AsyncDownloader, at most its `files` at the same time,
+        one thread starts them and this one puts them on the upload queue, so no thread waits on each file
+        :param jobs: [(url, out, size)]
+        :param done: queue of (file_path, target, disk bytes held)
+        :return:
+        """
+        finished = queue.Queue()
+        feeder = threading.Thread(target=self._submit_small, args=(jobs, workdir, prefix, finished))
+        feeder.start()
+        for _ in range(len(jobs)):
+            future, file_path, target, disk_bytes, start = finished.get()
+            try:
+                code = future.result() if future is not None else 1
+            except Exception as e:
+                LOG.error("Download %r failed: %s" % (target, e))
+                code = 1
+            if future is not None:
+                self.metrics.add("download", time.time() - start, target)
+            self._downloaded(code, file_path, target, disk_bytes, done)
+        feeder.join()
+
+    def _upload_shard(self, shard, results):
+        """
+        upload a tar shard and its index, then record its members finished
+        """
+        path, key, members = shard
+        index = "".join("%s\t%s\t%s\n" % (out, offset, size) for out, offset, size, checksum, d in members)
+        connections = self.connections.acquire(self.upload_threads)
+        try:
+            with self.metrics.timer("upload", key):
+                self.obs.upload(self.bucket, key, path, threads=self.upload_threads, journal=self.journal)
+            self._verify(path, key)
+            if self.obs.put(self.bucket, key + ".idx", index):
+                raise Exception("Upload %r failed" % (key + ".idx"))
+            LOG.info("%s files packed into %r" % (len(members), key))
+            for out, offset, size, checksum, d in members:
+                target = "%s/%s" % (self.packer.prefix, out)
+                self.packed[out] = key
+                callback = self._callback(target, "uploaded")
+                if callback is not None:
+                    callback(size)
+                results[target] = self._done(target, checksum, key)
+        except Exception as e:
+            LOG.error("Upload %r failed: %s" % (key, e))
+            for out, offset, size, checksum, d in members:
+                self._state("%s/%s" % (self.packer.prefix, out), "failed")
+        finally:
+            self.connections.release(connections)
+            self.disk_bytes.release(sum(d for out, offset, size, checksum, d in members))
+            try:
+                os.remove(path)
+            except OSError as e:
+                LOG.warning("Remove %r failed: %s" % (path, e))
+
+    def _remove(self, file_path):
+        """
+        remove a local file and its download record
+        """
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        if self.journal is not None:
+            self.journal.remove(file_path)
+
+    def upload_files(self, done, results):
+        """
+        upload files from the queue until None, the local file is removed after upload and verification,
+        a file failed is kept to resume
+        :param done: queue of (file_path, target, disk bytes held)
+        :param results: dict {target: {algorithm: hexdigest}} of success files
+        :return:
+        """
         while True:
-            d = fh.read(10*1024*1024)
-            if not d:
+            item = done.get()
+            if item is None:
                 break
-            r.update(d)
 
-    return r.hexdigest()
+            file_path, target, disk_bytes = item
+            try:
+                checksum = Checksum(self.algorithms)
+                pack = self.packer is not None and target not in self.methods and \
+                    os.path.getsize(file_path) <= self.pack_size
+            except Exception as e:
+                # an uploader must not die, downloaders would block on the queue
+                LOG.error("Upload %r failed: %s" % (target, e))
+                self._state(target, "failed")
+                self.disk_bytes.release(disk_bytes)
+                continue
+
+            if pack:
+                try:
+                    shard = self.packer.add(file_path, target[len(self.packer.prefix) + 1:], checksum, disk_bytes)
+                    self._state(target, "packed")
+                    disk_bytes = 0
+                    self._remove(file_path)
+                except Exception as e:
+                    LOG.error("Pack %r failed: %s" % (target, e))
+                    self._state(target, "failed")
+                    shard = None
+                finally:
+                    self.disk_bytes.release(disk_bytes)
+                if shard is not None:
+                    self._upload_shard(shard, results)
+                continue
+
+            try:
+                self._upload(file_path, target, checksum)
+                self._verify(file_path, target, checksum.size if target in self.methods else None)
+                results[target] = self._done(target, checksum)
+                self._remove(file_path)
+            except Exception as e:
+                # the file and its download record are kept, so a resumed task uploads it again
+                LOG.error("Upload %r failed: %s" % (target, e))
+                self._state(target, "failed")
+            finally:
+                self.disk_bytes.release(disk_bytes)
+
+    def run(self, urls, outs, workdir, prefix, journal=None, progress=None, metrics=None, methods=None):
+        """
+        files are downloaded by `files` workers and put on a bounded queue,
+        `uploads` workers drain the queue, so uploads overlap with downloads.
+        small files of an AsyncDownloader are downloaded on its event loop, see download_small
+        :param urls:
+        :param outs:
+        :param workdir: 本地目录
+        :param prefix: obs 目录
+        :param journal: Journal, files finished are skipped and unfinished transfers resumed
+        :param progress: Progress to report bytes and state of each file
+        :param metrics: Metrics to record timings, bytes and retries of each file
+        :param methods: dict {out: bgzf or zstd} of outs compressed before upload, checksums of their
+                        content before compression are kept in self.originals
+        :return: OrderedDict {out: {algorithm: hexdigest}} of success files, in order of outs
+        """
+        self.journal = journal
+        self.progress = progress
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.downloader.metrics = self.metrics
+        self.obs.metrics = self.metrics
+        self.prefix = prefix
+        self.packed = {}
+        self.shards = {}
+        self.methods = dict(("%s/%s" % (prefix, o), m) for o, m in (methods or {}).items())
+        self.originals = {}
+        self.packer = None
+        if self.pack_size and not self.stream:
+            self.packer = Packer(workdir, prefix, os.path.basename(os.path.abspath(workdir)),
+                                 min(self.shard_size, self.disk_bytes.total // 2))
+        results = {}
+        todo = []
+        for url, out in zip(urls, outs):
+            target = "%s/%s" % (prefix, out)
+            r = self._is_done(target)
+            if r is None:
+                todo.append((url, out))
+            else:
+                results[target] = r
+
+        with ThreadPoolExecutor(max_workers=self.files) as executor:
+            sizes = [(m or {}).get("size", 0) for m in executor.map(self.downloader.probe, [i[0] for i in todo])]
+
+        jobs = sorted([(url, out, size) for (url, out), size in zip(todo, sizes)], key=lambda d: d[2], reverse=True)
+        if progress is not None:
+            for target in results:
+                progress.add(target, 0, "done")
+            for url, out, size in jobs:
+                progress.add("%s/%s" % (prefix, out), size)
+        if self.stream:
+            with ThreadPoolExecutor(max_workers=self.files) as executor:
+                futures = {}
+                for url, out, size in jobs:
+                    futures[out] = executor.submit(self.stream_file, url, "%s/%s" % (prefix, out))
+            for out, future in futures.items():
+                if future.result() is not None:
+                    results["%s/%s" % (prefix, out)] = future.result()
+        else:
+            done = queue.Queue(maxsize=self.queue_size)
+            with ThreadPoolExecutor(max_workers=self.uploads) as uploaders:
+                for _ in range(self.uploads):
+                    uploaders.submit(self.upload_files, done, results)
+
+                small = []
+                if isinstance(self.downloader, AsyncDownloader):
+                    small = [j for j in jobs if j[2] <= self.downloader.small_size]
+                    jobs = [j for j in jobs if j[2] > self.downloader.small_size]
+                with ThreadPoolExecutor(max_workers=self.files) as executor:
+                    for url, out, size in jobs:
+                        executor.submit(self.download_file, url, os.path.join(workdir, out),
+                                        "%s/%s" % (prefix, out), size, done)
+                    if small:
+                        self.download_small(small, workdir, prefix, done)
+
+                for _ in range(self.uploads):
+                    done.put(None)
+
+            shard = self.packer.close() if self.packer is not None else None
+            if shard is not None:
+                self._upload_shard(shard, results)
+
+        r = OrderedDict()
+        for out in outs:
+            target = "%s/%s" % (prefix, out)
+            if target in results:
+                r[out] = results[target]
+
+        return r
 
 
 def read_cfg(cfg):
     with open(cfg) as fh:
-        r = json.loads(fh.read(), encoding="utf-8")
+        r = json.loads(fh.read())
 
     return r
 
 
+def read_boot(path):
+    """
+    boot phase timings written by the user data of the server
+    :param path:
+    :return: dict {phase: seconds} and boot_time, or None
+    """
+    if not os.path.isfile(path):
+        return None
+
+    with open(path) as fh:
+        r = json.loads(fh.read())
+
+    return OrderedDict([
+        ("boot", r["uptime"]),
+        ("install", r["installed"] - r["start"]),
+        ("start", time.time() - r["installed"]),
+        ("boot_time", r["start"] - r["uptime"])
+    ])
+
+
+def create_scheduler(cfg, obs=None, small=False):
+    """
+    create the obs client, downloader and scheduler from worker config
+    :param cfg:
+    :param obs: OBS, created from cfg by default
+    :param small: for tasks of many small files, use AsyncDownloader, async_files small files at the same time
+    :return: obs, downloader, scheduler
+    """
+    if small:
+        downloader = AsyncDownloader(threads=cfg.get("download_threads", 1),
+                                     small_size=cfg.get("small_size", SMALL_SIZE),
+                                     connections=cfg.get("async_connections", 256), per_host=cfg.get("per_host", 32),
+                                     files=cfg.get("async_files", 128))
+        # threads are left to the files larger than small_size, small ones share the event loop
+        files, connections = cfg.get("files", 4), cfg.get("async_connections", 256)
+    else:
+        downloader = Downloader(threads=cfg.get("download_threads", 1))
+        files, connections = cfg.get("files", 4), cfg.get("connections", 32)
+    if obs is None:
+        obs = OBS(
+            ak=cfg["ak"], sk=cfg["sk"], region=cfg["region"], server=cfg.get("server")
+        )
+    scheduler = Scheduler(
+        downloader, obs, cfg["bucket"],
+        files=files,
+        connections=connections,
+        upload_threads=cfg.get("upload_threads", 4),
+        upload_bytes=cfg.get("upload_bytes", 512*1024*1024),
+        disk_bytes=cfg.get("disk_bytes"),
+        uploads=cfg.get("uploads", 2),
+        queue_size=cfg.get("queue_size", 4),
+        part_size=cfg.get("part_size"),
+        stream=cfg.get("stream", False),
+        pack_size=cfg.get("pack_size", 0),
+        shard_size=cfg.get("shard_size", 1024*1024*1024),
+        compress_threads=cfg.get("compress_threads"),
+        algorithms=get_algorithms(cfg)
+    )
+
+    return obs, downloader, scheduler
+
+
+def is_small_task(cfg, meta, urls):
+    """
+    engine "auto" uses AsyncDownloader when at least async_min_files files,
+    and 80% of the task, are not larger than small_size
+    :param meta: dict {url: meta} of the task
+    :return: bool
+    """
+    engine = cfg.get("engine", "auto")
+    if engine != "auto":
+        return engine == "async"
+
+    small_size = cfg.get("small_size", SMALL_SIZE)
+    sizes = [(meta.get(Downloader.mirrors(u)[0]) or {}).get("size") for u in urls]
+    n = len([i for i in sizes if i is not None and i <= small_size])
+
+    return n >= cfg.get("async_min_files", 64) and n >= 0.8 * len(urls)
+
+
+def get_algorithms(cfg):
+
+    return ["md5"] + [i for i in cfg.get("checksums", []) if i != "md5"]
+
+
+def register(index, downloader, urls, outs, folder, results, skip=()):
+    """
+    add downloaded files to the dedup index, a failure only loses the
+    chance to copy them later
+    :param index: DedupIndex
+    :param results: dict {out: {algorithm: hexdigest}}
+    :param skip: outs packed into tar shards or compressed, their objects are not copies of the sources
+    :return:
+    """
+    for url, out in zip(urls, outs):
+        if out not in results or out in skip:
+            continue
+        for mirror in Downloader.mirrors(url):
+            meta = downloader.meta.get(mirror)
+            if not meta:
+                continue
+            try:
+                index.register(mirror, meta, "%s/%s" % (folder, out), results[out])
+            except Exception as e:
+                LOG.warning("Register %r failed. %s" % (mirror, e))
+
+
+def run_task(cfg, obs, downloader, scheduler, task, boot=None):
+    """
+    run one task file, upload manifests, metrics and log next to it
+    :param cfg: worker config
+    :param obs:
+    :param downloader:
+    :param scheduler:
+    :param task: task file in bucket, date/uid/name.cfg
+    :param boot: boot timings from read_boot, for the first task after boot
+    :return:
+    """
+    bucket = cfg["bucket"]
+    algorithms = get_algorithms(cfg)
+    _date, _uid = task.split("/")[:2]
+    _name = os.path.basename(task)[:-len(".cfg")]
+    if not os.path.isdir(_name):
+        os.makedirs(_name)
+    log_path = os.path.join(_name, "%s.log" % _name)
+    metrics_path = os.path.join(_name, "%s.metrics.json" % _name)
+    manifests = {name: "" for name in algorithms}
+    metrics = Metrics()
+    engine = None
+    state = "failed"
+    start = time.time()
+
+    # a handler per task, basicConfig only works for the first one
+    handler = logging.FileHandler(log_path)
+    handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s', '%d %b %Y %H:%M:%S'))
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(handler)
+    # published from the start, so a task failed before transfer is seen by the client as well
+    progress = Progress(obs, bucket, "%s/%s/%s.progress" % (_date, _uid, _name), cfg.get("progress_interval", 10))
+    progress.start()
+
+    try:
+        if boot:
+            LOG.info("boot %.1fs, install %.1fs, start %.1fs" % (boot["boot"], boot["install"], boot["start"]))
+            for phase in ("boot", "install", "start"):
+                metrics.add(phase, boot[phase])
+        task_file = os.path.join(_name, "%s.cfg" % _name)
+        obs.download(bucket, task, task_file)
+        v = read_cfg(task_file)[_name]
+        if is_small_task(cfg, v.get("meta", {}), v["urls"]):
+            try:
+                obs, downloader, scheduler = create_scheduler(cfg, obs, small=True)
+                engine = downloader
+                LOG.info("Download %s files on the event loop" % len(v["urls"]))
+            except Exception as e:
+                LOG.warning("Use threads instead. %s" % e)
+        downloader.meta.update(v.get("meta", {}))
+        journal = Journal(os.path.join(_name, "%s.journal" % _name))
+        with metrics.timer("transfer"):
+            results = scheduler.run(v["urls"], v["outs"], _name, "%s/%s" % (_date, _uid), journal, progress,
+                                    metrics, v.get("compress"))
+        if boot and progress.first_byte:
+            LOG.info("first byte %.1fs after boot" % (progress.first_byte - boot["boot_time"]))
+            metrics.add("first_byte", progress.first_byte - boot["boot_time"])
+        methods = v.get("compress", {})
+        for out, digests in results.items():
+            for name, value in digests.items():
+                manifests[name] += "%s\t%s\n" % (value, out)
+            if out in methods:
+                # checksums of the content before compression, under the name without suffix
+                original = scheduler.originals["%s/%s/%s" % (_date, _uid, out)]
+                for name, value in original.items():
+                    manifests[name] += "%s\t%s\n" % (value, original_name(out, methods[out]))
+
+        LOG.info("create %s" % ", ".join(algorithms))
+        for name, content in manifests.items():
+            path = os.path.join(_name, "%s.%s" % (_name, name))
+            with open(path, "w") as fh:
+                fh.write(content)
+            obs.upload(bucket, "%s/%s/%s.%s" % (_date, _uid, _name, name), path)
+        if cfg.get("dedup", True):
+            register(DedupIndex(obs, bucket), downloader, v["urls"], v["outs"], "%s/%s" % (_date, _uid), results,
+                     set(scheduler.packed) | set(methods))
+        state = "finished"
+    finally:
+        metrics.add("task", time.time() - start)
+        with open(metrics_path, "w") as fh:
+            fh.write(json.dumps(dict(metrics.to_dict(), task=_name, state=state, time=time.time()), indent=2))
+        root.removeHandler(handler)
+        handler.close()
+        try:
+            obs.upload(bucket, "%s/%s/%s.metrics.json" % (_date, _uid, _name), metrics_path)
+            obs.upload(bucket, "%s/%s/%s.log" % (_date, _uid, _name), log_path)
+        except Exception as e:
+            LOG.error("Upload log of %s failed: %s" % (_name, e))
+        if engine is not None:
+            engine.close()
+        progress.stop(state)
+
+
 def do_download(cfg):
     """
     {
@@ -40,56 +940,128 @@ def do_download(cfg):
         "sk": "replace_with_your_sk",
         "region": "replace_with_region",
         "bucket": "replace_with_your_bucket",
+        "download_threads": 1,
+        "upload_threads": 4,
+        "stream": false,
+        "checksums": ["md5"],
+        "files": 4,
+        "connections": 32,
+        "upload_bytes": 536870912,
+        "disk_bytes": null,
+        "uploads": 2,
+        "queue_size": 4,
+        "part_size": null,
+        "progress_interval": 10,
+        "boot_file": "/etc/hwget_boot.json",
+        "server": null,
+        "dedup": true,
+        "engine": "auto",
+        "small_size": 8388608,
+        "async_min_files": 64,
+        "async_files": 128,
+        "async_connections": 256,
+        "per_host": 32,
+        "pack_size": 0,
+        "shard_size": 1073741824,
+        "compress_threads": null,
         "tasks": [task_file]
 
     }
+    a task file is {name: {"urls": [], "outs": [], "meta": {url: meta}, "compress": {out: "bgzf" or "zstd"}}}
     :param cfg: config file
 
     :return:
     """
+    boot = read_boot(cfg.get("boot_file", "/etc/hwget_boot.json"))
+    obs, downloader, scheduler = create_scheduler(cfg)
 
-    bucket = cfg["bucket"]
-    downloader = Downloader()
-    obs = OBS(
-        ak=cfg["ak"], sk=cfg["sk"], region=cfg["region"]
-    )
-    tasks = cfg["tasks"]
-
-    for task in tasks:
-        _date, _uid = task.split("/")[:2]
-        os.mkdir(_uid)
-        log_path = os.path.join(_uid, "%s.log" % _uid)
-        md5_path = os.path.join(_uid, "%s.md5" % _uid)
-        md5_content = ""
-
-        logging.basicConfig(
-            level=logging.INFO,
-            filename=log_path,
-            format='%(asctime)s [%(levelname)s] %(message)s',
-            datefmt='%d %b %Y %H:%M:%S'
-        )
-        task_file = os.path.join(_uid, "%s.cfg" % _uid)
-        obs.download(bucket, task, task_file)
-        v = read_cfg(task_file)[_uid]
-        for url, out in zip(v["urls"], v["outs"]):
-            file_path = os.path.join(_uid, out)
-            target = "%s/%s/%s" % (_date, _uid, out)
-            response = downloader.download(url, file_path)
-            if not response:
-                obs.upload(bucket, target, file_path)
-                md5_content += "%s\t%s\n" % (create_md5(file_path), out)
-
-        LOG.info("create md5")
-        with open(md5_path, "w") as fh:
-            fh.write(md5_content)
-        obs.upload(bucket, "%s/%s/%s.md5" % (_date, _uid, _uid), md5_path)
-        logging.shutdown()
-        obs.upload(bucket, "%s/%s/%s.log" % (_date, _uid, _uid), log_path)
+    for task in cfg["tasks"]:
+        run_task(cfg, obs, downloader, scheduler, task, boot)
+        boot = None
+
+
+def do_daemon(cfg):
+    """
+    run tasks from the queue back to back, exit after idle timeout
+    extra config keys:
+        "queue": "queue/",
+        "worker": "worker id, default: hostname",
+        "poll_interval": 10,
+        "idle_timeout": 600,
+        "claim_timeout": 300, claims of workers without heartbeat for this long are released
+    :param cfg:
+    :return:
+    """
+    boot = read_boot(cfg.get("boot_file", "/etc/hwget_boot.json"))
+    obs, downloader, scheduler = create_scheduler(cfg)
+    tasks = TaskQueue(obs, cfg["bucket"], cfg.get("queue", "queue/"))
+    worker = cfg.get("worker") or socket.gethostname()
+    poll_interval = cfg.get("poll_interval", 10)
+    idle_timeout = cfg.get("idle_timeout", 600)
+    claim_timeout = cfg.get("claim_timeout", 300)
+
+    state = {"state": "idle"}
+    stopped = threading.Event()
+
+    def beat():
+        while not stopped.is_set():
+            try:
+                tasks.heartbeat(worker, state["state"])
+            except Exception as e:
+                LOG.warning("Heartbeat failed. %s" % e)
+            stopped.wait(poll_interval)
+
+    thread = threading.Thread(target=beat)
+    thread.daemon = True
+    thread.start()
+
+    idle_since = time.time()
+    errors = 0
+    try:
+        while True:
+            try:
+                claimed = tasks.claim(worker, claim_timeout)
+                errors = 0
+            except Exception as e:
+                # the queue is polled again, tasks left there are not lost to an OBS error
+                errors += 1
+                LOG.error("Claim task failed. %s" % e)
+                if time.time() - idle_since >= idle_timeout:
+                    LOG.info("%s idle for %ss, exit" % (worker, idle_timeout))
+                    break
+                time.sleep(min(poll_interval * 2 ** errors, 300))
+                continue
+            if claimed:
+                name, task = claimed
+                state["state"] = "busy"
+                try:
+                    run_task(cfg, obs, downloader, scheduler, task, boot)
+                    boot = None
+                except Exception as e:
+                    LOG.error("Task %s failed. %s" % (name, e))
+                finally:
+                    try:
+                        tasks.finish(name, task)
+                    except Exception as e:
+                        LOG.error("Finish task %s failed. %s" % (name, e))
+                state["state"] = "idle"
+                idle_since = time.time()
+                continue
+
+            if time.time() - idle_since >= idle_timeout:
+                LOG.info("%s idle for %ss, exit" % (worker, idle_timeout))
+                break
+            time.sleep(poll_interval)
+    finally:
+        stopped.set()
+        thread.join()
+        tasks.leave(worker)
 
 
 def add_args(parser):
 
     parser.add_argument("cfg", help="config")
+    parser.add_argument("--daemon", action="store_true", help="run tasks from the queue in bucket until idle timeout")
 
     return parser
 
@@ -105,7 +1077,10 @@ def main():
     parser = add_args(parser)
     args = parser.parse_args()
     cfg = read_cfg(args.cfg)
-    do_download(cfg)
+    if args.daemon:
+        do_daemon(cfg)
+    else:
+        do_download(cfg)
 
 
 if __name__ == "__main__":
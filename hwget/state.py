@@ -0,0 +1,241 @@
+# -*- coding:utf-8 -*-
+"""
+local sqlite state of a manifest of url/output pairs, so a large catalog is
+probed once and submitted in batches, and a re-run only looks at rows not
+done through indexed lookups
+"""
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+
+LOG = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL,
+    out TEXT NOT NULL UNIQUE,
+    size INTEGER,
+    meta TEXT,
+    probed REAL,
+    job TEXT,
+    state TEXT NOT NULL DEFAULT 'new'
+);
+CREATE INDEX IF NOT EXISTS files_state ON files (state, id);
+CREATE INDEX IF NOT EXISTS files_job ON files (job);
+CREATE TABLE IF NOT EXISTS jobs (
+    name TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    files INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    finished REAL,
+    tasks TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+"""
+
+
+class State(object):
+    """
+    files: url is the mirrors of a file separated by spaces, out unique as
+    the object name, meta the json {url: meta} of each mirror. state goes new -> ready or unreachable after
+    probe -> submitted with the job -> done or failed
+    jobs: name is the folder date/uid in bucket, state running or finished,
+    tasks the json {"servers": {id: task}, "queued": [task]} it runs on
+    """
+
+    def __init__(self, path):
+        """
+
+        :param path: sqlite file
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def parse(lines):
+        """
+        parse a manifest of "url\\tout" lines, mirrors of a file are separated
+        by spaces, out is the file name of the first url by default. blank
+        lines and lines start with # are skipped
+        :param lines: iterable of str
+        :return: generator of (url, out)
+        """
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            items = line.split("\t")
+            urls = items[0].split()
+            out = items[1].strip() if len(items) > 1 and items[1].strip() else urls[0].split("/")[-1]
+            yield " ".join(urls), out
+
+    def load(self, lines, batch=10000):
+        """
+        import a manifest, rows known already are skipped. out is the object name in the folder of a job,
+        so a row whose out is known with another url is rejected, not loaded
+        :param lines: iterable of "url\\tout" lines, see parse
+        :param batch: 每次提交的行数
+        :return: (rows added, rows read, [(url, out)] rows rejected)
+        """
+        added = read = 0
+        rows = []
+        rejected = []
+        with self.lock:
+            for row in self.parse(lines):
+                rows.append(row)
+                if len(rows) >= batch:
+                    added += self._insert(rows, rejected)
+                    read += len(rows)
+                    rows = []
+            if rows:
+                added += self._insert(rows, rejected)
+                read += len(rows)
+
+        for url, out in rejected[:10]:
+            LOG.error("%r is the output of another url, %r rejected" % (out, url))
+        LOG.info("Load {:,} rows, {:,} new, {:,} rejected".format(read, added, len(rejected)))
+        return added, read, rejected
+
+    def _insert(self, rows, rejected):
+        """
+        :param rejected: list rows whose out is known with another url are appended to
+        :return: rows added
+        """
+        added = 0
+        with self.db:
+            for url, out in rows:
+                if self.db.execute("INSERT OR IGNORE INTO files (url, out) VALUES (?, ?)", (url, out)).rowcount:
+                    added += 1
+                elif self.db.execute("SELECT url FROM files WHERE out = ?", (out,)).fetchone()[0] != url:
+                    rejected.append((url, out))
+
+        return added
+
+    def to_probe(self, limit=1000):
+        """
+        :return: list [(id, url)] of rows not probed yet
+        """
+        with self.lock:
+            return self.db.execute(
+                "SELECT id, url FROM files WHERE state = 'new' ORDER BY id LIMIT ?", (limit,)).fetchall()
+
+    def set_probed(self, rows):
+        """
+        :param rows: list [(id, size, meta)], size None if unreachable, meta dict {url: meta}
+        :return:
+        """
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany(
+                "UPDATE files SET size = ?, meta = ?, probed = ?, state = ? WHERE id = ?",
+                [(size, json.dumps(meta), now, "unreachable" if size is None else "ready", i)
+                 for i, size, meta in rows])
+
+    def ready(self, limit=1000):
+        """
+        :return: list [(id, url, out, size, meta)] of rows probed and not submitted
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, url, out, size, meta FROM files WHERE state = 'ready' ORDER BY id LIMIT ?",
+                (limit,)).fetchall()
+
+        return [(i, url, out, size, json.loads(meta)) for i, url, out, size, meta in rows]
+
+    def start_job(self, name, ids):
+        """
+        assign rows to a job
+        :param name: folder date/uid
+        :param ids: row ids
+        :return:
+        """
+        with self.lock, self.db:
+            self.db.executemany("UPDATE files SET job = ?, state = 'submitted' WHERE id = ?",
+                                [(name, i) for i in ids])
+            size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM files WHERE job = ?", (name,)).fetchone()[0]
+            self.db.execute("INSERT OR REPLACE INTO jobs (name, state, files, size, created) VALUES (?, ?, ?, ?, ?)",
+                            (name, "running", len(ids), size, time.time()))
+
+    def running_jobs(self):
+        """
+        :return: list names of jobs not finished, like those interrupted
+        """
+        with self.lock:
+            return [r[0] for r in self.db.execute("SELECT name FROM jobs WHERE state = 'running' ORDER BY created")]
+
+    def set_tasks(self, name, servers, queued=()):
+        """
+        record what a job runs on, so an interrupted run waits on them again
+        :param servers: dict {server id: task name}
+        :param queued: task names submitted to the queue
+        :return:
+        """
+        with self.lock, self.db:
+            self.db.execute("UPDATE jobs SET tasks = ? WHERE name = ?",
+                            (json.dumps({"servers": servers, "queued": list(queued)}), name))
+
+    def job_tasks(self, name):
+        """
+        :return: (servers, queued) recorded by set_tasks, None if not recorded
+        """
+        with self.lock:
+            row = self.db.execute("SELECT tasks FROM jobs WHERE name = ?", (name,)).fetchone()
+        if not row or not row[0]:
+            return None
+        tasks = json.loads(row[0])
+
+        return tasks["servers"], tasks["queued"]
+
+    def job_files(self, name):
+        """
+        :return: list [(id, url, out, size, meta)] of a job
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, url, out, size, meta FROM files WHERE job = ? ORDER BY id", (name,)).fetchall()
+
+        return [(i, url, out, size, json.loads(meta)) for i, url, out, size, meta in rows]
+
+    def finish_job(self, name, failed=()):
+        """
+        :param name:
+        :param failed: outs failed, others of the job are done
+        :return:
+        """
+        with self.lock, self.db:
+            self.db.execute("UPDATE files SET state = 'done' WHERE job = ?", (name,))
+            self.db.executemany("UPDATE files SET state = 'failed' WHERE job = ? AND out = ?",
+                                [(name, out) for out in failed])
+            self.db.execute("UPDATE jobs SET state = 'finished', finished = ? WHERE name = ?", (time.time(), name))
+
+    def retry(self, states=("failed",)):
+        """
+        put rows back to probe
+        :param states: failed, unreachable
+        :return: rows reset
+        """
+        with self.lock, self.db:
+            n = 0
+            for state in states:
+                n += self.db.execute("UPDATE files SET state = 'new', job = NULL WHERE state = ?", (state,)).rowcount
+
+        return n
+
+    def counts(self):
+        """
+        :return: dict {state: rows}
+        """
+        with self.lock:
+            return dict(self.db.execute("SELECT state, COUNT(*) FROM files GROUP BY state").fetchall())
@@ -30,6 +30,13 @@ setup(
     version=get_version(),
     packages=find_packages(),
     install_requires=get_requirements(),
+    python_requires=">=3.6",
+    extras_require={"async": ["aiohttp"], "zstd": ["zstandard"], "crc32c": ["crcmod"]},
+    entry_points={
+        "console_scripts": [
+            "hwget = hwget.cli:main",
+        ]
+    },
     description='Download data with HuaWei cloud',
     url="https://github.com/FlyPythons/hwget",
 )
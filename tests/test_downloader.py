@@ -0,0 +1,50 @@
+# -*- coding:utf-8 -*-
+import unittest
+
+from hwget.base import Downloader
+
+MB = 1024 * 1024
+
+
+class SplitTest(unittest.TestCase):
+
+    @staticmethod
+    def covered(ranges):
+        r = []
+        for start, end in sorted(ranges):
+            if r and start <= r[-1][1]:
+                r[-1][1] = max(r[-1][1], end)
+            else:
+                r.append([start, end])
+        return r
+
+    def test_split_evenly(self):
+        downloader = Downloader(threads=4, min_segment_size=MB)
+        self.assertEqual(downloader._split(100 * MB), [(0, 25 * MB), (25 * MB, 50 * MB), (50 * MB, 75 * MB),
+                                                       (75 * MB, 100 * MB)])
+
+    def test_small_file_is_not_split_below_min_segment_size(self):
+        downloader = Downloader(threads=8, min_segment_size=16 * MB)
+        self.assertEqual(downloader._split(20 * MB), [(0, 20 * MB)])
+
+    def test_only_holes_are_downloaded(self):
+        downloader = Downloader(threads=4, min_segment_size=MB)
+        done = [(0, 10 * MB), (30 * MB, 40 * MB)]
+        ranges = downloader._split(100 * MB, done)
+        self.assertEqual(self.covered(ranges), [[10 * MB, 30 * MB], [40 * MB, 100 * MB]])
+        self.assertEqual(len(ranges), 4)
+
+    def test_many_holes_give_one_range_each(self):
+        downloader = Downloader(threads=2, min_segment_size=MB)
+        done = [(i * MB, i * MB + MB // 2) for i in range(0, 10)]
+        ranges = downloader._split(10 * MB, done)
+        self.assertEqual(len(ranges), 10)
+        self.assertEqual(self.covered(ranges + done), [[0, 10 * MB]])
+
+    def test_done_file(self):
+        downloader = Downloader(threads=4, min_segment_size=MB)
+        self.assertEqual(downloader._split(10 * MB, [(0, 10 * MB)]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
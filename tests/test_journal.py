@@ -0,0 +1,62 @@
+# -*- coding:utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from hwget.base import Journal
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="hwget_test_")
+        self.path = os.path.join(self.root, "journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_ranges_are_merged(self):
+        journal = Journal(self.path)
+        journal.add_range("f", 10, 20)
+        journal.add_range("f", 0, 5)
+        journal.add_range("f", 20, 30)
+        journal.add_range("f", 4, 8)
+        journal.add_range("f", 40, 50)
+        self.assertEqual(journal.get("f")["ranges"], [[0, 8], [10, 30], [40, 50]])
+
+    def test_contained_and_empty_ranges(self):
+        journal = Journal(self.path)
+        journal.add_range("f", 0, 100)
+        journal.add_range("f", 10, 20)
+        journal.add_range("f", 50, 50)
+        self.assertEqual(journal.get("f")["ranges"], [[0, 100]])
+
+    def test_saved_records_are_loaded(self):
+        journal = Journal(self.path, interval=3600)
+        journal.reset("f", url="http://example/f", size=100)
+        journal.add_range("f", 0, 10)
+        journal.add_part("t", 1, "etag1")
+        journal.save()
+
+        loaded = Journal(self.path)
+        self.assertEqual(loaded.get("f"), {"url": "http://example/f", "size": 100, "ranges": [[0, 10]]})
+        self.assertEqual(loaded.get("t"), {"parts": {"1": "etag1"}})
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+    def test_get_returns_a_copy(self):
+        journal = Journal(self.path)
+        journal.add_range("f", 0, 10)
+        journal.get("f")["ranges"].append([20, 30])
+        self.assertEqual(journal.get("f")["ranges"], [[0, 10]])
+        self.assertEqual(journal.get("missing"), {})
+
+    def test_remove(self):
+        journal = Journal(self.path)
+        journal.update("f", done={"md5": "x"})
+        journal.remove("f")
+        self.assertEqual(Journal(self.path).get("f"), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
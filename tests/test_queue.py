@@ -0,0 +1,125 @@
+# -*- coding:utf-8 -*-
+import json
+import time
+import threading
+import unittest
+
+from hwget.base import TaskQueue
+
+
+class MemoryOBS(object):
+    """
+    the part of OBS used by TaskQueue, objects are kept in a dict
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def put(self, bucket, target, content):
+        with self.lock:
+            self.objects[target] = content.encode("utf-8") if isinstance(content, str) else content
+        return 0
+
+    def create(self, bucket, target, content):
+        with self.lock:
+            if target in self.objects:
+                return False
+            self.objects[target] = content.encode("utf-8")
+            return True
+
+    def get(self, bucket, target):
+        with self.lock:
+            return self.objects.get(target)
+
+    def delete(self, bucket, target):
+        with self.lock:
+            self.objects.pop(target, None)
+
+    def iter_objects(self, bucket, prefix):
+        with self.lock:
+            keys = sorted(k for k in self.objects if k.startswith(prefix))
+        for key in keys:
+            yield key, 0
+
+
+class TaskQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.obs = MemoryOBS()
+        self.tasks = TaskQueue(self.obs, "bucket")
+
+    def test_claim_in_order(self):
+        self.tasks.submit("a", "20200101/a/a.cfg")
+        self.tasks.submit("b", "20200101/b/b.cfg")
+        self.assertEqual(self.tasks.claim("w1"), ("a", "20200101/a/a.cfg"))
+        self.assertEqual(self.tasks.claim("w2"), ("b", "20200101/b/b.cfg"))
+        self.assertIsNone(self.tasks.claim("w1"))
+        self.assertEqual(json.loads(self.obs.get("bucket", "queue/claimed/a").decode("utf-8"))["worker"], "w1")
+
+    def test_finish_removes_claim(self):
+        self.tasks.submit("a", "task")
+        self.tasks.claim("w1")
+        self.tasks.finish("a", "task")
+        self.assertEqual([k for k in self.obs.objects if k.startswith("queue/")], [])
+
+    def test_task_submitted_again_while_running_is_kept(self):
+        self.tasks.submit("a", "task1")
+        self.tasks.claim("w1")
+        self.tasks.submit("a", "task2")
+        self.tasks.finish("a", "task1")
+        self.assertEqual(self.tasks.claim("w2"), ("a", "task2"))
+
+    def test_stale_claim_is_released(self):
+        self.tasks.submit("a", "task")
+        self.tasks.heartbeat("w1", "busy")
+        self.assertEqual(self.tasks.claim("w1"), ("a", "task"))
+        # w1 died without finishing the task
+        self.obs.put("bucket", "queue/workers/w1", json.dumps({"time": time.time() - 3600, "state": "busy"}))
+        self.obs.put("bucket", "queue/claimed/a", json.dumps({"worker": "w1", "time": time.time() - 3600}))
+        self.assertEqual(self.tasks.claim("w2", timeout=60), ("a", "task"))
+        self.assertEqual(json.loads(self.obs.get("bucket", "queue/claimed/a").decode("utf-8"))["worker"], "w2")
+
+    def test_claim_of_live_worker_is_kept(self):
+        self.tasks.submit("a", "task")
+        self.tasks.heartbeat("w1", "busy")
+        self.tasks.claim("w1")
+        self.obs.put("bucket", "queue/claimed/a", json.dumps({"worker": "w1", "time": time.time() - 3600}))
+        self.assertIsNone(self.tasks.claim("w2", timeout=60))
+
+    def test_new_claim_without_heartbeat_is_kept(self):
+        self.tasks.submit("a", "task")
+        self.tasks.claim("w1")
+        self.assertIsNone(self.tasks.claim("w2", timeout=60))
+
+    def test_each_task_is_claimed_once(self):
+        names = ["t%03d" % i for i in range(50)]
+        for name in names:
+            self.tasks.submit(name, name)
+        claimed = []
+        lock = threading.Lock()
+
+        def work(worker):
+            while True:
+                r = self.tasks.claim(worker)
+                if r is None:
+                    return
+                with lock:
+                    claimed.append(r[0])
+
+        threads = [threading.Thread(target=work, args=("w%s" % i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(claimed), names)
+
+    def test_workers(self):
+        self.tasks.heartbeat("w1", "idle")
+        self.assertEqual(self.tasks.workers(), {"w1": "idle"})
+        self.tasks.leave("w1")
+        self.assertEqual(self.tasks.workers(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+# -*- coding:utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from hwget.state import State
+
+
+class StateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="hwget_test_")
+        self.state = State(os.path.join(self.root, "state.db"))
+
+    def tearDown(self):
+        self.state.close()
+        shutil.rmtree(self.root)
+
+    def test_load_skips_known_rows(self):
+        self.assertEqual(self.state.load(["http://x/a\ta", "http://x/b"], batch=1), (2, 2, []))
+        self.assertEqual(self.state.load(["http://x/a\ta", "http://x/b\tb", "http://x/c\tc"]), (1, 3, []))
+        self.assertEqual(self.state.counts(), {"new": 3})
+
+    def test_output_of_another_url_is_rejected(self):
+        added, read, rejected = self.state.load(["http://x/a\ta", "http://y/a\ta", "http://x/b\tb"])
+        self.assertEqual((added, read), (2, 3))
+        self.assertEqual(rejected, [("http://y/a", "a")])
+        self.assertEqual(self.state.load(["http://z/a\ta"])[2], [("http://z/a", "a")])
+        self.assertEqual([url for i, url in self.state.to_probe()], ["http://x/a", "http://x/b"])
+
+
+if __name__ == "__main__":
+    unittest.main()